@@ -0,0 +1,80 @@
+"""
+bgio.py: a small, bounded pool of background threads for the side outputs
+of a run (reference files, harvested XML), so that the main thread can go
+on parsing while they are written.  submit() blocks once max_pending tasks
+are queued or running, so a slow filesystem holds up the run instead of
+letting the queue grow without limit.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundIOException(Exception):
+    pass
+
+
+class BackgroundIO(object):
+
+    def __init__(self, threads=2, max_pending=64, on_error=None):
+        self.threads = threads
+        self.max_pending = max_pending
+        # called with the exception of any task that raises one
+        self.on_error = on_error
+        self.nerrors = 0
+        self._executor = None
+        self._slots = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.threads,
+                                            thread_name_prefix="bgio")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        return self
+
+    def submit(self, func, *args, **kwargs):
+        if self._executor is None:
+            raise BackgroundIOException("Background I/O is not open")
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+        err = future.exception()
+        if err is not None:
+            self.nerrors += 1
+            if self.on_error:
+                self.on_error(err)
+
+    def drain(self):
+        # waits for everything submitted so far
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # already reported by _done
+                pass
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
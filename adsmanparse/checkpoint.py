@@ -0,0 +1,110 @@
+"""
+checkpoint.py: periodic checkpoints for long run.py batch jobs.  A
+checkpoint is one JSON line appended to a log next to the output file,
+giving the size of the tagged output once it was flushed to disk and the
+inputs whose records are complete in that output.  Resuming truncates the
+output to the last checkpointed size, dropping any partially written tail,
+and skips the inputs already done.
+"""
+import json
+import os
+
+
+class CheckpointException(Exception):
+    pass
+
+
+class Checkpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Returns (offset, done) from the checkpoint log, or (None, set())
+        if there is none.  A last line cut short by a crash is ignored.
+        """
+        offset = None
+        done = set()
+        if not os.path.isfile(self.path):
+            return (offset, done)
+        try:
+            with open(self.path, "r") as fc:
+                for l in fc:
+                    try:
+                        entry = json.loads(l)
+                    except ValueError:
+                        continue
+                    offset = entry.get("offset", offset)
+                    done.update(entry.get("done", []))
+        except Exception as err:
+            raise CheckpointException("Failed to load checkpoint %s: %s" % (self.path, err))
+        return (offset, done)
+
+    def save(self, offset, done, reset=False):
+        try:
+            with open(self.path, "w" if reset else "a") as fc:
+                fc.write("%s\n" % json.dumps({"offset": offset, "done": list(done)}))
+                fc.flush()
+                os.fsync(fc.fileno())
+        except Exception as err:
+            raise CheckpointException("Failed to write checkpoint %s: %s" % (self.path, err))
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class Checkpointer(object):
+    """
+    Tracks the inputs completed since the last checkpoint, and every
+    `interval` results syncs the output writer and saves a checkpoint.
+    Functions in before_checkpoint are called before each one, and those
+    in on_checkpoint after.
+    """
+
+    def __init__(self, checkpoint, output, interval=500, on_checkpoint=None,
+                 before_checkpoint=None):
+        self.checkpoint = checkpoint
+        self.output = output
+        self.interval = interval
+        self.on_checkpoint = on_checkpoint or []
+        self.before_checkpoint = before_checkpoint or []
+        self.pending = []
+
+    def start(self, resume=False):
+        # returns the inputs that are already done
+        done = set()
+        if resume:
+            (offset, done) = self.checkpoint.load()
+        self.checkpoint.save(self.output.sync(), done, reset=True)
+        return done
+
+    def add(self, key):
+        self.pending.append(key)
+        if len(self.pending) >= self.interval:
+            self.save()
+
+    def save(self):
+        for f in self.before_checkpoint:
+            f()
+        self.checkpoint.save(self.output.sync(), self.pending)
+        self.pending = []
+        for f in self.on_checkpoint:
+            f()
+
+    def finish(self):
+        self.save()
+        self.checkpoint.remove()
+
+
+def truncate_output(path, offset):
+    """
+    Drops anything written to path after offset; returns the number of
+    bytes removed.
+    """
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    if offset is None or size <= offset:
+        return 0
+    os.truncate(path, offset)
+    return size - offset
@@ -1,11 +1,67 @@
-import itertools
 import re
 import string
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from namedentities import named_entities
 
 re_empty_affil = re.compile(r"\w{2,3}\(\)")
 
+# entities named_entities leaves in place that the tagged format replaces
+CLEAN_ENTITIES = {"&lsquo;": "\'",
+                  "&rsquo;": "\'",
+                  "&ldquo;": "\"",
+                  "&rdquo;": "\"",
+                  "&nbsp;": " ",
+                  "&zwnj;": " "}
+re_clean_entities = re.compile(r"&(?:[rl]squo|[rl]dquo|nbsp|zwnj);")
+
+
+def clean_entity(match):
+    return CLEAN_ENTITIES[match.group(0)]
+
+
+FIELD_DICT = OrderedDict([
+    ('bibcode', {'tag': 'R'}),
+    ('title', {'tag': 'T'}),
+    ('authors', {'tag': 'A', 'join': '; '}),
+    ('native_authors', {'tag': 'n', 'join': ', '}),
+    ('affiliations', {'tag': 'F', 'join': ', '}),
+    ('pubdate', {'tag': 'D'}),
+    ('publication', {'tag': 'J'}),
+    ('language', {'tag': 'M'}),
+    ('comments', {'tag': 'X', 'join': '; '}),
+    ('source', {'tag': 'G'}),
+    ('copyright', {'tag': 'C'}),
+    ('uatkeys', {'tag': 'U', 'join': ', '}),
+    ('keywords', {'tag': 'K', 'join': ', '}),
+    ('subjectcategory', {'tag': 'Q', 'join': '; '}),
+    ('database', {'tag': 'W', 'join': '; '}),
+    ('page', {'tag': 'P'}),
+    ('abstract', {'tag': 'B'}),
+    ('properties', {'tag': 'I', 'join': '; '}),
+    ('references', {'tag': 'Z', 'join': "\n"}),])
+
+# affiliation labels AA..ZZ then AAA..ZZZ, shared by all serializers in the
+# process and only generated as far as the largest author list seen so far
+AFF_LABEL = []
+MAX_AFF_LABELS = 26 * 26 + 26 * 26 * 26
+
+
+def aff_labels(count):
+    letters = string.ascii_uppercase
+    for i in range(len(AFF_LABEL), min(count, MAX_AFF_LABELS)):
+        if i < 676:
+            AFF_LABEL.append(letters[i // 26] + letters[i % 26])
+        else:
+            j = i - 676
+            AFF_LABEL.append(letters[j // 676] + letters[(j // 26) % 26] + letters[j % 26])
+    return AFF_LABEL
+
+
+# text is the tagged record, bibcode the %R value (or None), and fields an
+# OrderedDict of the cleaned value of each field in text
+TaggedRecord = namedtuple("TaggedRecord", ["text", "bibcode", "fields"])
+
+
 class ClassicSerializer(object):
     """
     ClassicSerializer: creates a classic tagged record from a record in
@@ -13,61 +69,42 @@ class ClassicSerializer(object):
 
     ClassicSerializer().output returns the classic-formatted record as a
     single string (including carriage returns) that can be written to a file.
+    A serializer holds no per-record state, so one instance can be reused
+    for any number of records.
     """
 
-
-    def _aff_codes_generator(self):
-        letters = [c for c in string.ascii_uppercase]
-        two_char = ["%c%c" % (x, y) for (x, y) in \
-            itertools.product(letters, letters)]
-        three_char = ["%s%c" % (x, y) for (x, y) in \
-            itertools.product(two_char, letters)]
-        return two_char + three_char
-
     def _clean_string(self, data):
+        # named_entities only changes non-ASCII characters and &...;
+        # entities, so plain ASCII text without an ampersand is returned as is
+        if isinstance(data, str) and data.isascii() and "&" not in data:
+            return data
         data = named_entities(data)
-        data = re.sub(r"&[rl]squo;", "\'", data)
-        data = re.sub(r"&[rl]dquo;", "\"", data)
-        data = re.sub(r"&nbsp;", " ", data)
-        data = re.sub(r"&zwnj;", " ", data)
+        if "&" in data:
+            data = re_clean_entities.sub(clean_entity, data)
         return data
 
     def __init__(self, **kwargs):
-        self.AFF_LABEL = self._aff_codes_generator()
         self.TAG_REFS = kwargs.get("tag_refs", False)
-        self.FIELD_DICT = OrderedDict([
-            ('bibcode', {'tag': 'R'}),
-            ('title', {'tag': 'T'}),
-            ('authors', {'tag': 'A', 'join': '; '}),
-            ('native_authors', {'tag': 'n', 'join': ', '}),
-            ('affiliations', {'tag': 'F', 'join': ', '}),
-            ('pubdate', {'tag': 'D'}),
-            ('publication', {'tag': 'J'}),
-            ('language', {'tag': 'M'}),
-            ('comments', {'tag': 'X', 'join': '; '}),
-            ('source', {'tag': 'G'}),
-            ('copyright', {'tag': 'C'}),
-            ('uatkeys', {'tag': 'U', 'join': ', '}),
-            ('keywords', {'tag': 'K', 'join': ', '}),
-            ('subjectcategory', {'tag': 'Q', 'join': '; '}),
-            ('database', {'tag': 'W', 'join': '; '}),
-            ('page', {'tag': 'P'}),
-            ('abstract', {'tag': 'B'}),
-            ('properties', {'tag': 'I', 'join': '; '}),
-            ('references', {'tag': 'Z', 'join': "\n"}),])
-        pass
+        self.FIELD_DICT = FIELD_DICT
 
     def _format_affil_field(self, affils):
         formatted_affils = []
         if affils:
+            labels = aff_labels(len(affils))
             for i in range(len(affils)):
                 if affils[i]:
-                    f = "%s(%s)" % (self.AFF_LABEL[i], affils[i])
+                    f = "%s(%s)" % (labels[i], affils[i])
                     formatted_affils.append(f)
         return formatted_affils
 
-    def output(self, record):
+    def serialize(self, record):
+        """
+        Returns a TaggedRecord: the tagged text, plus the bibcode and the
+        cleaned value of each field written, so callers don't have to
+        parse them back out of the text.
+        """
         output_text = []
+        fields = OrderedDict()
         if self.TAG_REFS:
             if record.get("refhandler_list", None):
                 record["references"] = record["refhandler_list"]
@@ -84,7 +121,11 @@ class ClassicSerializer(object):
                elif isinstance(rec_field, dict):
                    rec_field = join_str.join(
                        ["%s: %s" % (fk, fv) for fk, fv in rec_field.items()])
-               line_out = "%s%s %s\n" % ("%", tag, self._clean_string(rec_field))
+               fields[k] = self._clean_string(rec_field)
+               line_out = "%s%s %s\n" % ("%", tag, fields[k])
                output_text.append(line_out)
         output = "".join(output_text)
-        return output
+        return TaggedRecord(output, fields.get("bibcode", None), fields)
+
+    def output(self, record):
+        return self.serialize(record).text
@@ -2,9 +2,15 @@
 counter.py: an object to store and manipulate counter-type page number
 assignments for ADS Classic bibcodes.  This intended for bibstems that use
 counters to set the page, absent a page or electronic id.
+
+Counter keeps the counters in a JSON file that is rewritten on every call;
+SQLiteCounter keeps them in an SQLite database, where each increment (or
+block of increments) is a single transaction, so concurrent jobs can't hand
+out the same page.  SQLiteCounter.migrate_from_json imports a JSON file.
 """
 import json
 import os
+import sqlite3
 
 class JSONLoadException(Exception):
     pass
@@ -22,6 +28,10 @@ class CounterSyntaxException(Exception):
     pass
 
 
+class CounterMigrationException(Exception):
+    pass
+
+
 class Counter(object):
 
     def __init__(self):
@@ -71,3 +81,80 @@ class Counter(object):
                 raise GetPageException("Counter increment failed: %s" % err)
         else:
             raise CounterSyntaxException("Call get_page with bibstem, year, and path to counter.json!")
+
+
+class SQLiteCounter(object):
+
+    def __init__(self, timeout=60.):
+        self.timeout = timeout
+
+    def _connect(self, dbfile):
+        conn = sqlite3.connect(dbfile, timeout=self.timeout, isolation_level=None)
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (bibstem TEXT NOT NULL, year TEXT NOT NULL, page INTEGER NOT NULL, PRIMARY KEY (bibstem, year))")
+        return conn
+
+    def get_pages(self, bibstem, year, count, dbfile):
+        """
+        Reserves count consecutive pages for bibstem and year in one
+        transaction, and returns them as a list.  As with Counter, a
+        bibstem with an "ALL" counter uses it regardless of year.
+        """
+        if bibstem and year and dbfile and count > 0:
+            year = str(year)
+            try:
+                conn = self._connect(dbfile)
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        row = conn.execute("SELECT page FROM counters WHERE bibstem = ? AND year = ?",
+                                           (bibstem, "ALL")).fetchone()
+                        if row and row[0]:
+                            key = "ALL"
+                        else:
+                            key = year
+                            row = conn.execute("SELECT page FROM counters WHERE bibstem = ? AND year = ?",
+                                               (bibstem, year)).fetchone()
+                        page = row[0] if row else 0
+                        conn.execute("INSERT OR REPLACE INTO counters VALUES (?, ?, ?)",
+                                     (bibstem, key, page + count))
+                        conn.execute("COMMIT")
+                    except Exception:
+                        conn.execute("ROLLBACK")
+                        raise
+                finally:
+                    conn.close()
+                return list(range(page + 1, page + count + 1))
+            except Exception as err:
+                raise GetPageException("Counter increment failed: %s" % err)
+        else:
+            raise CounterSyntaxException("Call get_pages with bibstem, year, a positive count, and path to the counter database!")
+
+    def get_page(self, bibstem, year, dbfile):
+        return self.get_pages(bibstem, year, 1, dbfile)[0]
+
+    def migrate_from_json(self, infile, dbfile):
+        """
+        Imports the counters in a JSON counter file.  Where the database
+        already has a counter, the larger of the two values is kept, so a
+        migration never hands out a page a second time.
+        """
+        try:
+            bibdata = Counter()._initialize_from_json(infile)
+            rows = []
+            for (bibstem, counters) in bibdata.items():
+                for (year, page) in counters.items():
+                    rows.append((bibstem, str(year), int(page)))
+            conn = self._connect(dbfile)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("INSERT INTO counters VALUES (?, ?, ?) ON CONFLICT (bibstem, year) DO UPDATE SET page = MAX(page, excluded.page)", rows)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.close()
+            return len(rows)
+        except Exception as err:
+            raise CounterMigrationException("Failed to migrate %s to %s: %s" % (infile, dbfile, err))
@@ -1,18 +1,291 @@
 from adsmanparse.exceptions import *
-from habanero.cn import content_negotiation as CoNe
+from adsmanparse import utils
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import os
+import re
+import threading
+import time
+
+# HTTP status codes worth retrying: rate limiting and server-side errors
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def doi_to_path(doi):
+    # relative path of a DOI's record in the run.py write_xml layout
+    doi_parts = doi.split("/")
+    path = []
+    if "http" in doi_parts[0].lower():
+        doi_parts = doi_parts[3:]
+    for d in doi_parts:
+        path.append(re.sub(r"[^\w_. -]+", "_", d))
+    return "/".join(path)+'.xml'
+
+
+class DoiCache(object):
+    """
+    On-disk cache of harvested records, keyed by DOI and record format.
+    Entries older than max_age seconds are ignored, and once the cache
+    holds more than max_bytes the least recently stored entries are
+    evicted.  warm_dirs are directories in the write_xml layout (see
+    doi_to_path), whose crossref-xml records are used on a cache miss.
+    stats counts hits, warm hits, misses, stores and evictions.
+    """
+
+    def __init__(self, cache_dir, max_age=None, max_bytes=None, warm_dirs=None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.warm_dirs = warm_dirs or []
+        self.stats = {'hits': 0, 'warm_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] += n
+
+    def _path(self, doi, recformat):
+        key = hashlib.sha1(doi.strip().lower().encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, recformat, key[0:2], key + '.dat')
+
+    def _is_fresh(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return False
+        return not self.max_age or (time.time() - mtime) <= self.max_age
+
+    def _read(self, path):
+        with open(path, 'r', encoding='utf-8') as fc:
+            return fc.read()
+
+    def get(self, doi, recformat='crossref-xml'):
+        path = self._path(doi, recformat)
+        if self._is_fresh(path):
+            try:
+                data = self._read(path)
+            except Exception as err:
+                pass
+            else:
+                self._count('hits')
+                return data
+        if recformat == 'crossref-xml':
+            for warm_dir in self.warm_dirs:
+                warm_path = os.path.join(warm_dir, doi_to_path(doi))
+                if self._is_fresh(warm_path):
+                    try:
+                        # write_xml adds a newline to the record
+                        data = self._read(warm_path)[:-1]
+                    except Exception as err:
+                        continue
+                    self._count('warm_hits')
+                    self.put(doi, recformat, data)
+                    return data
+        self._count('misses')
+        return None
+
+    def put(self, doi, recformat, data):
+        path = self._path(doi, recformat)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with utils.atomic_open(path, 'w', encoding='utf-8') as fc:
+                fc.write(data)
+        except Exception as err:
+            print('Failed to cache record for DOI=%s: %s' % (doi, err))
+            return
+        self._count('stores')
+        if self.max_bytes:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(os.path.getsize(p) for (m, p) in self._entries())
+                else:
+                    self._size += len(data.encode('utf-8'))
+                over = self._size > self.max_bytes
+            if over:
+                self.evict()
+
+    def _entries(self):
+        for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+            for f in filenames:
+                if f.endswith('.dat'):
+                    p = os.path.join(dirpath, f)
+                    try:
+                        yield (os.path.getmtime(p), p)
+                    except OSError:
+                        pass
+
+    def evict(self):
+        # evicts down to 90% of max_bytes, so that every store after the
+        # cache fills doesn't trigger another scan
+        with self._lock:
+            entries = sorted(self._entries())
+            size = sum(os.path.getsize(p) for (m, p) in entries)
+            for (mtime, path) in entries:
+                if size <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    fsize = os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= fsize
+                self.stats['evictions'] += 1
+            self._size = size
 
 
 class DoiHarvester(object):
 
-    def __init__(self, doi=None, recformat='crossref-xml'):
+    def __init__(self, doi=None, recformat='crossref-xml', cache=None):
         self.doi = doi
         self.recformat = recformat
+        self.cache = cache
 
     def get_record(self):
         if self.doi:
+            if self.cache:
+                record = self.cache.get(self.doi, self.recformat)
+                if record is not None:
+                    return record
             try:
-                return CoNe(ids = self.doi, format=self.recformat)
+                from habanero.cn import content_negotiation as CoNe
+                record = CoNe(ids = self.doi, format=self.recformat)
             except Exception as err:
                 raise HarvestFailException('Error fetching record for DOI=%s: %s' % (self.doi, err))
+            if self.cache:
+                self.cache.put(self.doi, self.recformat, record)
+            return record
         else:
             raise NoDoiException('No DOI supplied!')
+
+
+class DoiHarvestPool(object):
+    """
+    Fetches many DOIs concurrently by content negotiation, as DoiHarvester
+    does one at a time.  All requests share one HTTP session (and its
+    connection pool), at most `concurrency` are in flight, requests start
+    no faster than `rate_limit` per second, and 429 and 5xx responses are
+    retried with exponential backoff (or after the server's Retry-After).
+    base_url can point at a local stub server for testing.  With a DoiCache,
+    cached records are returned without a request, and fetched ones stored.
+    """
+
+    def __init__(self, recformat='crossref-xml', concurrency=4, rate_limit=10.,
+                 max_retries=3, backoff=1., timeout=60., base_url='https://doi.org',
+                 mailto=None, session=None, cache=None):
+        self.recformat = recformat
+        self.concurrency = max(1, int(concurrency))
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.base_url = base_url.rstrip('/')
+        self.mailto = mailto
+        self.session = session
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._next_request = 0.
+
+    def _get_session(self):
+        if self.session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def _get_headers(self):
+        from habanero.cn_formats import cn_format_headers
+        from habanero.habanero_utils import make_ua
+        headers = make_ua(mailto=self.mailto)
+        headers['Accept'] = cn_format_headers[self.recformat]
+        return headers
+
+    def _throttle(self):
+        # spaces request start times at least 1/rate_limit seconds apart
+        if self.rate_limit:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_request)
+                self._next_request = start + 1. / self.rate_limit
+            if start > now:
+                time.sleep(start - now)
+
+    def _retry_delay(self, response, attempt):
+        delay = self.backoff * (2 ** attempt)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def fetch(self, doi, headers=None):
+        if not doi:
+            raise NoDoiException('No DOI supplied!')
+        session = self._get_session()
+        if headers is None:
+            headers = self._get_headers()
+        url = self.base_url + '/' + doi
+        attempt = 0
+        while True:
+            self._throttle()
+            response = None
+            try:
+                response = session.get(url, headers=headers, allow_redirects=True,
+                                       timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    response.encoding = 'UTF-8'
+                    return response.text
+                err = 'HTTP status %s' % response.status_code
+            except Exception as e:
+                if response is not None:
+                    raise HarvestFailException('Error fetching record for DOI=%s: %s' % (doi, e))
+                err = e
+            if attempt >= self.max_retries:
+                raise HarvestFailException('Error fetching record for DOI=%s after %s attempts: %s' % (doi, attempt + 1, err))
+            time.sleep(self._retry_delay(response, attempt))
+            attempt += 1
+
+    def harvest(self, dois):
+        """
+        Generator yielding (doi, record, error) for each DOI in dois, in the
+        order the fetches finish; error is None on success, and record is
+        None on failure.  Only a few DOIs beyond those in flight are taken
+        from dois at a time, so it can be a generator over a large list.
+        """
+        headers = self._get_headers()
+        dois = iter(dois)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {}
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < 2 * self.concurrency:
+                    try:
+                        doi = next(dois)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        record = None
+                        if self.cache:
+                            record = self.cache.get(doi, self.recformat)
+                        if record is not None:
+                            yield (doi, record, None)
+                        else:
+                            pending[executor.submit(self.fetch, doi, headers)] = doi
+                if not pending:
+                    break
+                (done, not_done) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    doi = pending.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as err:
+                        yield (doi, None, err)
+                    else:
+                        if self.cache:
+                            self.cache.put(doi, self.recformat, record)
+                        yield (doi, record, None)
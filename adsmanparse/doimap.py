@@ -0,0 +1,204 @@
+"""
+doimap.py: a compact, immutable on-disk index of the DOI -> bibcode mapping
+in all.links.  The index is an SQLite file built once from the links file;
+lookups are O(log n) B-tree queries, and any number of processes can open
+the same index read-only without loading the mapping into memory.
+
+LazyDoiBibcodeMap defers all of this to the first lookup, and keeps the
+index as a snapshot that is rebuilt only when the links file changes.
+"""
+import argparse
+import fcntl
+import os
+import sqlite3
+from adsmanparse import utils
+from adsmanparse.exceptions import *
+
+
+def build_doi_index(infile, outfile):
+    """
+    Builds the index file outfile from the links file infile.  The index
+    is written to a temporary file and renamed into place when complete, so
+    readers never see a partial index.  As with utils.load_doi_bibcode, the
+    first bibcode seen for a DOI is the one kept.  Malformed lines are
+    skipped; returns the number of them.
+    """
+    bad_lines = []
+
+    def bad_line(lineno, err):
+        if len(bad_lines) < 10:
+            print("Skipping malformed line %s of %s: %s" % (lineno, infile, err))
+        bad_lines.append(lineno)
+
+    try:
+        stat = os.stat(infile)
+        with utils.replacing(outfile) as tmpfile:
+            conn = sqlite3.connect(tmpfile)
+            try:
+                conn.execute("PRAGMA journal_mode=OFF")
+                conn.execute("PRAGMA synchronous=OFF")
+                conn.execute("CREATE TABLE doibib (doi TEXT PRIMARY KEY, bibcode TEXT NOT NULL) WITHOUT ROWID")
+                conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.executemany("INSERT OR IGNORE INTO doibib VALUES (?, ?)",
+                                 utils.iter_doi_bibcode(infile, on_error=bad_line))
+                conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                 [("source", os.path.realpath(infile)),
+                                  ("source_mtime", repr(stat.st_mtime)),
+                                  ("source_size", str(stat.st_size)),
+                                  ("bad_lines", str(len(bad_lines)))])
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as err:
+        raise DoiIndexBuildException("Failed to build doi-bibcode index %s: %s" % (outfile, err))
+    if bad_lines:
+        print("Skipped %s malformed lines of %s" % (len(bad_lines), infile))
+    return len(bad_lines)
+
+
+class DoiBibcodeIndex(object):
+    """
+    Read-only, dict-like view of an index made by build_doi_index, usable
+    anywhere the dict from utils.load_doi_bibcode is (e.g. as the doibib
+    argument to translator.Translator).  The database is opened on first
+    lookup, and reopened in a child process after a fork.
+    """
+
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            if not os.path.isfile(self.indexfile):
+                raise DoiIndexLoadException("Index file %s does not exist." % self.indexfile)
+            uri = "file:%s?mode=ro&immutable=1" % os.path.realpath(self.indexfile)
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, doi, default=None):
+        row = self._connect().execute("SELECT bibcode FROM doibib WHERE doi = ?",
+                                      (doi,)).fetchone()
+        if row:
+            return row[0]
+        return default
+
+    def meta(self):
+        return dict(self._connect().execute("SELECT key, value FROM meta").fetchall())
+
+    def __getitem__(self, doi):
+        bibcode = self.get(doi)
+        if bibcode is None:
+            raise KeyError(doi)
+        return bibcode
+
+    def __contains__(self, doi):
+        return self.get(doi) is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM doibib").fetchone()[0]
+
+    def __bool__(self):
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+
+
+class LazyDoiBibcodeMap(object):
+    """
+    Dict-like DOI -> bibcode mapping that does nothing until the first
+    lookup.  It then opens the snapshot index (by default the links file
+    path plus ".db"), provided the snapshot was built from a links file
+    with the same mtime and size as the current one; otherwise the
+    snapshot is rebuilt first.  If the snapshot can't be built, the links
+    file is loaded into memory as before.
+    """
+
+    def __init__(self, linksfile, snapshot=None):
+        self.linksfile = linksfile
+        self.snapshot = snapshot or "%s.db" % linksfile
+        self._map = None
+
+    def _snapshot_is_current(self, stat):
+        if not os.path.isfile(self.snapshot):
+            return False
+        index = DoiBibcodeIndex(self.snapshot)
+        try:
+            meta = index.meta()
+            return (meta.get("source_mtime", None) == repr(stat.st_mtime) and
+                    meta.get("source_size", None) == str(stat.st_size))
+        except Exception as err:
+            return False
+        finally:
+            index.close()
+
+    def _load(self):
+        try:
+            stat = os.stat(self.linksfile)
+        except OSError:
+            if os.path.isfile(self.snapshot):
+                return DoiBibcodeIndex(self.snapshot)
+            return utils.load_doi_bibcode(self.linksfile)
+        if not self._snapshot_is_current(stat):
+            try:
+                # only one process rebuilds a stale snapshot, the others
+                # wait for it and then use the new one
+                with open(self.snapshot + ".lock", "w") as flock:
+                    fcntl.flock(flock, fcntl.LOCK_EX)
+                    if not self._snapshot_is_current(stat):
+                        build_doi_index(self.linksfile, self.snapshot)
+            except Exception as err:
+                print("Failed to update doi-bibcode snapshot, loading %s into memory: %s" % (self.linksfile, err))
+                return utils.load_doi_bibcode(self.linksfile)
+        return DoiBibcodeIndex(self.snapshot)
+
+    def _get_map(self):
+        if self._map is None:
+            self._map = self._load()
+        return self._map
+
+    @property
+    def loaded(self):
+        return self._map is not None
+
+    def get(self, doi, default=None):
+        return self._get_map().get(doi, default)
+
+    def __getitem__(self, doi):
+        return self._get_map()[doi]
+
+    def __contains__(self, doi):
+        return doi in self._get_map()
+
+    def __len__(self):
+        return len(self._get_map())
+
+    def __bool__(self):
+        return True
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser('Build a DOI -> bibcode index from a links file')
+
+    parser.add_argument('infile',
+                        help='Tab-separated bibcode/DOI links file (e.g. all.links)')
+
+    parser.add_argument('outfile',
+                        help='Path of the index file to create')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    build_doi_index(args.infile, args.outfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,11 @@ class NoDoiException(Exception):
 
 class NoParsedDataException(Exception):
     pass
+
+
+class DoiIndexBuildException(Exception):
+    pass
+
+
+class DoiIndexLoadException(Exception):
+    pass
@@ -0,0 +1,206 @@
+"""
+manifest.py: a persistent record of the input files a run has processed,
+keyed by path, with each file's size, mtime and content hash, the outcome
+of processing it and the bibcode written.  Rows are held back until the
+caller flushes them, after the output they describe is safely on disk.  RunManifest.is_changed lets
+run.py --incremental skip files that are unchanged since they were last
+processed, even if they have been touched or re-delivered since.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# an input with one of these statuses is done with, unless it changes
+DONE_STATUSES = ("written", "suppressed")
+
+
+class ManifestException(Exception):
+    pass
+
+
+def file_digest(path, blocksize=1048576):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class RunManifest(object):
+
+    def __init__(self, dbfile, commit_every=500):
+        self.dbfile = dbfile
+        self.commit_every = commit_every
+        self._conn = None
+        self._uncommitted = 0
+        # rows recorded but not yet saved: they are only saved by flush(),
+        # once the caller has made the output they describe durable
+        self._pending = []
+        # digests computed by is_changed, reused by record
+        self._digests = {}
+        # with --workers, is_changed is called from the thread feeding the
+        # pool while results are recorded from the main thread
+        self._lock = threading.RLock()
+
+    def open(self):
+        try:
+            self._conn = sqlite3.connect(self.dbfile, timeout=60., check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, status TEXT, bibcode TEXT, updated REAL)")
+        except Exception as err:
+            raise ManifestException("Failed to open manifest %s: %s" % (self.dbfile, err))
+        return self
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime, sha1, status, bibcode FROM files WHERE path = ?",
+                                     (path,)).fetchone()
+        if row:
+            return dict(zip(["size", "mtime", "sha1", "status", "bibcode"], row))
+        return None
+
+    def is_changed(self, path, stat=None):
+        """
+        Returns False if path was written before and is unchanged: either
+        its size and mtime match the manifest, or its content hash does (in
+        which case the new mtime is saved, so the hash isn't needed again).
+        Anything that was neither written nor suppressed last time (e.g. it
+        failed) is tried again.
+        """
+        entry = self.get(path)
+        if not entry or entry["status"] not in DONE_STATUSES:
+            return True
+        if stat is None:
+            stat = os.stat(path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return False
+        if entry["size"] != stat.st_size:
+            return True
+        digest = file_digest(path)
+        if digest != entry["sha1"]:
+            self._digests[path] = digest
+            return True
+        with self._lock:
+            self._conn.execute("UPDATE files SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+            self._commit()
+        return False
+
+    def digest(self, path):
+        # the content hash of path, reusing one is_changed computed
+        try:
+            return self._digests.pop(path, None) or file_digest(path)
+        except Exception as err:
+            raise ManifestException("Failed to hash %s: %s" % (path, err))
+
+    def record(self, path, status, bibcode=None, digest=None, stat=None):
+        # digest and stat, if given, are those of the data that was
+        # processed, so the file isn't read again (archive members, keyed
+        # archive!member, are given those of their archive)
+        try:
+            if stat is None:
+                stat = os.stat(path)
+            digest = digest or self._digests.pop(path, None) or file_digest(path)
+        except Exception as err:
+            raise ManifestException("Failed to record %s in manifest: %s" % (path, err))
+        with self._lock:
+            self._pending.append((path, stat.st_size, stat.st_mtime, digest, status, bibcode, time.time()))
+
+    def due(self):
+        # whether enough rows are pending that they should be flushed
+        return len(self._pending) >= self.commit_every
+
+    def flush(self):
+        """
+        Saves the rows recorded since the last flush.  A row saying a file
+        was written makes --incremental skip it, so this is only to be
+        called once the output holding its record is on disk.
+        """
+        with self._lock:
+            if self._pending:
+                self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       self._pending)
+                self._pending = []
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def _commit(self, force=False):
+        self._uncommitted += 1
+        if force or self._uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self, flush=True):
+        # with flush=False, rows still pending are dropped
+        with self._lock:
+            if self._conn is not None:
+                if flush:
+                    self.flush()
+                self._pending = []
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class ArchiveProgress(object):
+    """
+    Counts the members of each archive handed out for processing and the
+    results that have come back, and records the archive in the manifest
+    once all of them are in: as "written" if every member was read and
+    written (or suppressed), and as "failed" (so it is read again next time)
+    otherwise.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        # archive -> [members handed out, results back, failures, all handed out]
+        self._archives = {}
+        # archive -> (digest, stat) to record it with
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def add(self, archive):
+        with self._lock:
+            self._archives.setdefault(archive, [0, 0, 0, False])[0] += 1
+
+    def finish(self, archive, failures=0, digest=None, stat=None):
+        # all members of archive have been handed out; failures counts those
+        # that could not be read
+        with self._lock:
+            self._files[archive] = (digest, stat)
+            entry = self._archives.setdefault(archive, [0, 0, 0, False])
+            entry[2] += failures
+            entry[3] = True
+            complete = self._complete(archive)
+        if complete:
+            self._record(*complete)
+
+    def done(self, archive, status):
+        with self._lock:
+            entry = self._archives[archive]
+            entry[1] += 1
+            if status not in DONE_STATUSES:
+                entry[2] += 1
+            complete = self._complete(archive)
+        if complete:
+            self._record(*complete)
+
+    def _complete(self, archive):
+        (nmembers, nback, nfailed, finished) = self._archives[archive]
+        if finished and nback == nmembers:
+            del self._archives[archive]
+            return (archive, "failed" if nfailed else "written")
+        return None
+
+    def _record(self, archive, status):
+        with self._lock:
+            (digest, stat) = self._files.pop(archive, (None, None))
+        self.manifest.record(archive, status, digest=digest, stat=stat)
@@ -0,0 +1,191 @@
+"""
+metrics.py: counters and latency histograms for a run.  RunMetrics counts
+what happened to each input (files found, age-filtered, parsed, suppressed,
+translated, written, failures by site) and times each stage of processing,
+and writes them out as a Prometheus textfile (for the node_exporter textfile
+collector) and as a JSON summary.  Worker processes keep their own
+RunMetrics, and the parent merges in whatever they drain() after each
+record.
+"""
+import json
+import threading
+import time
+from adsmanparse import utils
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1., 2.5, 5., 10., 30.)
+
+METRIC_PREFIX = "adsmanparse_"
+
+
+class MetricsException(Exception):
+    pass
+
+
+class RunMetrics(object):
+
+    def __init__(self, prefix=None, labels={}, interval=0):
+        self.prefix = prefix
+        self.labels = dict(labels)
+        self.interval = interval
+        self.started = time.time()
+        # counters are keyed on (name, sorted label items), histograms on
+        # (name, sorted label items) as [bucket counts, sum, count]
+        self.counters = {}
+        self.histograms = {}
+        self._last_write = self.started
+        # background I/O threads count and time their work too
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key, None)
+            if hist is None:
+                hist = [[0] * len(BUCKETS), 0., 0]
+                self.histograms[key] = hist
+            for (i, bound) in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += seconds
+            hist[2] += 1
+
+    def stage(self, name, wrapped=None):
+        return _StageTimer(self, name, wrapped)
+
+    def drain(self):
+        # hands over (and forgets) everything observed since the last drain
+        with self._lock:
+            if not self.counters and not self.histograms:
+                return None
+            data = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return data
+
+    def merge(self, data):
+        (counters, histograms) = data
+        with self._lock:
+            for (key, value) in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (key, (buckets, total, count)) in histograms.items():
+                hist = self.histograms.get(key, None)
+                if hist is None:
+                    self.histograms[key] = [list(buckets), total, count]
+                else:
+                    hist[0] = [a + b for (a, b) in zip(hist[0], buckets)]
+                    hist[1] += total
+                    hist[2] += count
+
+    def _labelstr(self, labels, extra=None):
+        items = sorted(self.labels.items()) + list(labels)
+        if extra:
+            items.append(extra)
+        if not items:
+            return ""
+        return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for (k, v) in items])
+
+    def to_prometheus(self, now=None):
+        now = now or time.time()
+        lines = []
+        seen = set()
+        for ((name, labels), value) in sorted(self.counters.items()):
+            metric = METRIC_PREFIX + name + "_total"
+            if metric not in seen:
+                lines.append("# TYPE %s counter" % metric)
+                seen.add(metric)
+            lines.append("%s%s %s" % (metric, self._labelstr(labels), value))
+        for ((name, labels), (buckets, total, count)) in sorted(self.histograms.items()):
+            metric = METRIC_PREFIX + name + "_seconds"
+            if metric not in seen:
+                lines.append("# TYPE %s histogram" % metric)
+                seen.add(metric)
+            cumulative = 0
+            for (bound, n) in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append("%s_bucket%s %s" % (metric, self._labelstr(labels, ("le", repr(bound))), cumulative))
+            lines.append("%s_bucket%s %s" % (metric, self._labelstr(labels, ("le", "+Inf")), count))
+            lines.append("%s_sum%s %.6f" % (metric, self._labelstr(labels), total))
+            lines.append("%s_count%s %s" % (metric, self._labelstr(labels), count))
+        for (name, value) in [("run_start_timestamp_seconds", self.started),
+                              ("run_duration_seconds", now - self.started),
+                              ("last_export_timestamp_seconds", now)]:
+            lines.append("# TYPE %s%s gauge" % (METRIC_PREFIX, name))
+            lines.append("%s%s%s %.3f" % (METRIC_PREFIX, name, self._labelstr(()), value))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self, now=None):
+        now = now or time.time()
+        counters = {}
+        for ((name, labels), value) in sorted(self.counters.items()):
+            if labels:
+                # e.g. failures broken down by site
+                counters.setdefault(name, {})[",".join(["%s" % v for (k, v) in labels])] = value
+            else:
+                counters[name] = value
+        histograms = {}
+        for ((name, labels), (buckets, total, count)) in sorted(self.histograms.items()):
+            label = ",".join(["%s" % v for (k, v) in labels]) or name
+            histograms.setdefault(name, {})[label] = {
+                "count": count,
+                "sum": round(total, 6),
+                "mean": round(total / count, 6) if count else None,
+                "buckets": dict(zip([repr(b) for b in BUCKETS], buckets))}
+        return {"labels": self.labels,
+                "started": self.started,
+                "duration": round(now - self.started, 3),
+                "counters": counters,
+                "histograms": histograms}
+
+    def write(self):
+        # written to temp files and renamed into place, so the textfile
+        # collector never reads a partial file
+        now = time.time()
+        self._last_write = now
+        outfiles = []
+        with self._lock:
+            outputs = [(".prom", self.to_prometheus(now)),
+                       (".json", json.dumps(self.to_dict(now), indent=2, sort_keys=True) + "\n")]
+        for (suffix, text) in outputs:
+            path = self.prefix + suffix
+            try:
+                with utils.atomic_open(path) as fm:
+                    fm.write(text)
+            except Exception as err:
+                raise MetricsException("Failed to write metrics to %s: %s" % (path, err))
+            outfiles.append(path)
+        return outfiles
+
+    def maybe_write(self):
+        if self.interval and (time.time() - self._last_write) >= self.interval:
+            return self.write()
+        return None
+
+
+class _StageTimer(object):
+
+    def __init__(self, metrics, name, wrapped=None):
+        self.metrics = metrics
+        self.name = name
+        self.wrapped = wrapped
+        self.start = 0
+
+    def __enter__(self):
+        if self.wrapped is not None:
+            self.wrapped.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe("stage", time.perf_counter() - self.start, stage=self.name)
+        if self.wrapped is not None:
+            self.wrapped.__exit__(exc_type, exc_value, traceback)
+        return False
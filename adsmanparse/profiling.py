@@ -0,0 +1,128 @@
+"""
+profiling.py: optional CPU and memory profiling of a run.  RunProfiler
+wraps the processing loop in cProfile, writing the raw statistics to
+<prefix>.pstats and a summary of the top functions to <prefix>.txt, and
+can also trace allocations with tracemalloc to report the peak memory of
+each stage of processing (see RunProfiler.stage).  Stages may nest, and may
+run in background threads; tracemalloc only traces the process as a whole,
+so a stage's peak includes whatever other threads allocated while it ran.
+"""
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+
+
+class RunProfiler(object):
+
+    def __init__(self, prefix, cpu=True, memory=False, top=40):
+        self.prefix = prefix
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.stage_peaks = {}
+        # the highest memory in use at any point of the run
+        self.peak = 0
+        self._profile = None
+        self._snapshot = None
+        # tracemalloc keeps one peak for the whole process, and every stage
+        # resets it: before it does, the peak so far is passed on to the
+        # stages still running (in this thread or another) and to the run
+        self._active = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def stage(self, name):
+        return _MemoryStage(self, name) if self.memory else NULL_STAGE
+
+    def _fold_peak(self):
+        # called with _lock held; returns the memory in use now
+        (current, peak) = tracemalloc.get_traced_memory()
+        for stage in self._active:
+            stage.peak = max(stage.peak, peak)
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def _enter_stage(self, stage):
+        with self._lock:
+            stage.start = stage.peak = self._fold_peak()
+            self._active.append(stage)
+
+    def _exit_stage(self, stage):
+        with self._lock:
+            self._fold_peak()
+            self._active.remove(stage)
+            peak = stage.peak - stage.start
+            if peak > self.stage_peaks.get(stage.name, 0):
+                self.stage_peaks[stage.name] = peak
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self.prefix + ".pstats")
+        peak = None
+        if self.memory:
+            with self._lock:
+                self._fold_peak()
+            peak = self.peak
+            self._snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        with open(self.prefix + ".txt", "w") as fs:
+            fs.write(self.summary(peak))
+        return self.prefix + ".txt"
+
+    def summary(self, peak=None):
+        out = io.StringIO()
+        if self._profile:
+            for sort in ["cumulative", "tottime"]:
+                out.write("Top %s functions by %s time:\n" % (self.top, sort))
+                stats = pstats.Stats(self._profile, stream=out)
+                stats.strip_dirs().sort_stats(sort).print_stats(self.top)
+        if self.memory:
+            out.write("Peak traced memory: %.1f MiB\n\n" % (peak / 1048576.))
+            out.write("Peak memory by stage (above the memory in use at stage start):\n")
+            for (name, speak) in sorted(self.stage_peaks.items(), key=lambda x: -x[1]):
+                out.write("  %-16s %10.1f KiB\n" % (name, speak / 1024.))
+            if self._snapshot:
+                out.write("\nTop allocations still held at the end of the run:\n")
+                for stat in self._snapshot.statistics("lineno")[:self.top]:
+                    out.write("  %s\n" % stat)
+        return out.getvalue()
+
+
+class _MemoryStage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.profiler._enter_stage(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit_stage(self)
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = _NullStage()
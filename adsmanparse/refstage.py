@@ -0,0 +1,153 @@
+"""
+refstage.py: stages the reference files written with -w on local disk
+during a run, and commits them to the reference directory in bulk.  Each
+process (and each thread writing references) uses one reused
+ReferenceWriter and a pending directory of its own, named
+pending.<pid>.<thread>, and moves its files into the shared ready
+directory once a record is complete; commit() then moves everything that
+is ready into place with atomic renames, so readers never see a partial
+file.
+"""
+import errno
+import os
+import shutil
+import threading
+from adsmanparse import utils
+
+PENDING_PREFIX = "pending."
+READY_DIR = "ready"
+
+
+class ReferenceStagerException(Exception):
+    pass
+
+
+class ReferenceStager(object):
+
+    def __init__(self, ref_dir, staging_dir):
+        self.ref_dir = ref_dir
+        self.staging_dir = staging_dir
+        self.ready_dir = os.path.join(staging_dir, READY_DIR)
+        self.ncommitted = 0
+        # the writer and pending directory of each process and thread
+        self._local = threading.local()
+        self._commit_lock = threading.Lock()
+        # directories known to exist, so each one is only checked once
+        self._dirs = set()
+
+    def _remove_stale(self):
+        # drops the pending directories of processes that are gone; this
+        # process has nothing pending when it calls this, so its own go too
+        with os.scandir(self.staging_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith(PENDING_PREFIX):
+                    continue
+                try:
+                    pid = int(entry.name[len(PENDING_PREFIX):].split(".")[0])
+                except ValueError:
+                    continue
+                if pid == os.getpid() or not utils.pid_alive(pid):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+    def open(self):
+        # called once per run, before any worker starts: drops the pending
+        # files of records an earlier run never finished, and commits
+        # whatever it left ready
+        try:
+            os.makedirs(self.ready_dir, exist_ok=True)
+            self._remove_stale()
+        except Exception as err:
+            raise ReferenceStagerException("Failed to open reference staging directory %s: %s" % (self.staging_dir, err))
+        return self.commit()
+
+    def _makedirs(self, dirname):
+        if dirname not in self._dirs:
+            os.makedirs(dirname, exist_ok=True)
+            self._dirs.add(dirname)
+
+    def write(self, data, bibcode, source):
+        from adsenrich.references import ReferenceWriter
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # a forked worker inherits the parent's thread-local state, so
+            # it is reset here
+            local.pid = os.getpid()
+            local.pending_dir = os.path.join(self.staging_dir,
+                                             "%s%s.%s" % (PENDING_PREFIX, local.pid, threading.get_ident()), "")
+            local.writer = None
+        if local.writer is None:
+            local.writer = ReferenceWriter(reference_directory=local.pending_dir,
+                                           reference_source=source,
+                                           bibcode=bibcode,
+                                           data=data)
+        else:
+            local.writer.__init__(reference_directory=local.pending_dir,
+                                  reference_source=source,
+                                  bibcode=bibcode,
+                                  data=data)
+        try:
+            local.writer.write_references_to_file()
+        except Exception:
+            # nothing from a failed write is committed
+            shutil.rmtree(local.pending_dir, ignore_errors=True)
+            raise
+        self._publish(local.pending_dir)
+
+    def _publish(self, pending_dir):
+        # the pending directory only ever holds the current record
+        pending = pending_dir.rstrip(os.sep)
+        for (dirpath, dirnames, filenames) in os.walk(pending, topdown=False):
+            for f in filenames:
+                src = os.path.join(dirpath, f)
+                dest = os.path.join(self.ready_dir, os.path.relpath(src, pending))
+                self._makedirs(os.path.dirname(dest))
+                os.replace(src, dest)
+            if dirpath != pending:
+                os.rmdir(dirpath)
+
+    def _install(self, src, dest):
+        try:
+            os.replace(src, dest)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            # across filesystems: copy next to the destination, then rename
+            with utils.replacing(dest) as tmpfile:
+                shutil.copyfile(src, tmpfile)
+            os.remove(src)
+
+    def commit(self):
+        # returns the number of files moved into ref_dir
+        with self._commit_lock:
+            return self._commit()
+
+    def _commit(self):
+        ncommit = 0
+        errors = []
+        for (dirpath, dirnames, filenames) in os.walk(self.ready_dir):
+            for f in filenames:
+                src = os.path.join(dirpath, f)
+                dest = os.path.join(self.ref_dir, os.path.relpath(src, self.ready_dir))
+                try:
+                    self._makedirs(os.path.dirname(dest))
+                    self._install(src, dest)
+                    ncommit += 1
+                except Exception as err:
+                    errors.append("%s: %s" % (dest, err))
+        self.ncommitted += ncommit
+        if errors:
+            raise ReferenceStagerException("Failed to commit %s reference files, left in %s: %s"
+                                           % (len(errors), self.ready_dir, errors[0]))
+        return ncommit
+
+    def close(self):
+        # everything committed, so the staging directory can go, unless
+        # another live process still has files pending in it
+        self.commit()
+        self._remove_stale()
+        for (dirpath, dirnames, filenames) in os.walk(self.staging_dir, topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # not empty
+                pass
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from adsmanparse import manifest
+
+
+class TestRunManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, "manifest.db")
+        self.infile = os.path.join(self.tmpdir, "input.xml")
+        with open(self.infile, "w") as fw:
+            fw.write("<article/>\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unflushed_rows_are_not_saved(self):
+        # a run killed before its output was synced must not leave files
+        # marked written, or the next --incremental run skips them
+        fm = manifest.RunManifest(self.dbfile, commit_every=1).open()
+        fm.record(self.infile, "written", "2020ApJ...900....1A")
+        self.assertTrue(fm.due())
+        fm.close(flush=False)
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertIsNone(fm.get(self.infile))
+            self.assertTrue(fm.is_changed(self.infile))
+
+    def test_flushed_rows_are_saved(self):
+        fm = manifest.RunManifest(self.dbfile).open()
+        fm.record(self.infile, "written", "2020ApJ...900....1A")
+        self.assertFalse(fm.due())
+        fm.flush()
+        fm.close(flush=False)
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertEqual(fm.get(self.infile)["status"], "written")
+            self.assertFalse(fm.is_changed(self.infile))
+
+    def test_failed_file_is_changed(self):
+        with manifest.RunManifest(self.dbfile) as fm:
+            fm.record(self.infile, "failed")
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertEqual(fm.get(self.infile)["status"], "failed")
+            self.assertTrue(fm.is_changed(self.infile))
+
+    def test_suppressed_file_is_done(self):
+        # a suppressed title (e.g. an Index) is not parsed again every run
+        with manifest.RunManifest(self.dbfile) as fm:
+            fm.record(self.infile, "suppressed")
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertFalse(fm.is_changed(self.infile))
+
+    def test_archive_with_suppressed_member_is_written(self):
+        stat = os.stat(self.infile)
+        digest = manifest.file_digest(self.infile)
+        with manifest.RunManifest(self.dbfile) as fm:
+            progress = manifest.ArchiveProgress(fm)
+            for member in ("a.xml", "index.xml"):
+                progress.add(self.infile)
+            progress.finish(self.infile, digest=digest, stat=stat)
+            self.assertIsNone(fm.get(self.infile))
+            progress.done(self.infile, "written")
+            progress.done(self.infile, "suppressed")
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertEqual(fm.get(self.infile)["status"], "written")
+            self.assertFalse(fm.is_changed(self.infile))
+
+    def test_archive_with_failed_member_is_failed(self):
+        with manifest.RunManifest(self.dbfile) as fm:
+            progress = manifest.ArchiveProgress(fm)
+            progress.add(self.infile)
+            progress.add(self.infile)
+            progress.done(self.infile, "written")
+            progress.finish(self.infile)
+            progress.done(self.infile, "failed")
+        with manifest.RunManifest(self.dbfile) as fm:
+            self.assertEqual(fm.get(self.infile)["status"], "failed")
+            self.assertTrue(fm.is_changed(self.infile))
+
+
+if __name__ == "__main__":
+    unittest.main()
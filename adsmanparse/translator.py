@@ -1,15 +1,21 @@
 from adsmanparse.exceptions import *
-from adsenrich.bibcodes import BibcodeGenerator
-from bs4 import BeautifulSoup
 import re
 
 fix_ampersand = re.compile(r"(&amp;)(.*?)(;)")
 check_alphanumeric = re.compile(r"[A-Za-z]")
 
-try:
-    bibgen = BibcodeGenerator()
-except Exception as err:
-    print('Warning, BibcodeGenerator not initialized!')
+bibgen = None
+
+def get_bibgen():
+    # BibcodeGenerator is created on first use rather than at import
+    global bibgen
+    if bibgen is None:
+        try:
+            from adsenrich.bibcodes import BibcodeGenerator
+            bibgen = BibcodeGenerator()
+        except Exception as err:
+            print('Warning, BibcodeGenerator not initialized!')
+    return bibgen
 
 
 class Translator(object):
@@ -27,8 +33,14 @@ class Translator(object):
         self.doipage = doipage
         return
 
+    def reset(self, data=None):
+        # clears per-record state, so one Translator can be reused
+        self.data = data
+        self.output = dict()
+
     # DETAGGER (from jats.py)
     def _detag(self, r, tags_keep, **kwargs):
+        from bs4 import BeautifulSoup
 
         newr = BeautifulSoup(str(r), 'lxml-xml')
         try:
@@ -184,13 +196,17 @@ class Translator(object):
             author_list = list()
             affil_list = list()
             native_author_list = list()
+            # membership is tested against a set, as author lists can run
+            # to thousands of names
+            seen_authors = set()
             for a in authors:
                 name = a.get('name', None)
                 # individual (person or collab)
                 if name:
                     # person name
                     (auth, native_auth) = self._get_name(name)
-                    if auth not in author_list:
+                    if auth not in seen_authors:
+                        seen_authors.add(auth)
                         # person attribs and affil
                         aff = self._get_affil(a)
                         if aff == 'None':
@@ -479,7 +495,7 @@ class Translator(object):
                         if doi_bibcode and ".tmp" not in doi_bibcode:
                             self.output['bibcode'] = doi_bibcode
             if not self.output.get('bibcode', None):
-                self.output['bibcode'] = bibgen.make_bibcode(self.data, bibstem=bibstem, volume=volume)
+                self.output['bibcode'] = get_bibgen().make_bibcode(self.data, bibstem=bibstem, volume=volume)
         except Exception as err:
             print('Couldnt make a bibcode: %s' % str(err))
 
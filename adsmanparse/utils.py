@@ -1,7 +1,26 @@
+import contextlib
+import errno
+import gzip
+import io
+import json
+import os
 import re
-from bs4 import BeautifulSoup
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from fnmatch import fnmatch
+from glob import has_magic
 
-def has_body(data):
+# markup that can hide a <body> start tag from an XML parser is matched (and
+# skipped) ahead of the tag itself
+re_body_scan = re.compile(r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|"
+                          r"<(?:[A-Za-z_][\w.-]*:)?body[\s/>]", re.S)
+
+
+def has_body_soup(data):
+    from bs4 import BeautifulSoup
     try:
         soup = BeautifulSoup(data, 'lxml-xml')
     except Exception as err:
@@ -17,25 +36,386 @@ def has_body(data):
     return False
 
 
+def has_body(data):
+    """
+    Returns True if the document has a <body> element, without parsing it:
+    the scan stops at the first body start tag found outside of comments,
+    CDATA sections and processing instructions.  This gives the same answer
+    as has_body_soup (the original BeautifulSoup test).
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    if not isinstance(data, str):
+        return False
+    if 'body' not in data:
+        return False
+    for match in re_body_scan.finditer(data):
+        if match.group(0)[1] not in '!?':
+            return True
+    return False
+
+
+class TitleSuppressor(object):
+    """
+    Matches a title against a list of suppressed-title regexes in at most
+    two passes.  Patterns anchored with ^ are combined into one alternation
+    that is only tried at the start of the title, and the rest into one
+    alternation that is searched for; each pattern is a named group, so
+    match() can return the pattern that matched.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        anchored = []
+        floating = []
+        for (i, p) in enumerate(self.patterns):
+            if p.startswith('^') and '|' not in p:
+                anchored.append("(?P<t%s>%s)" % (i, p[1:]))
+            else:
+                floating.append("(?P<t%s>%s)" % (i, p))
+        self.re_anchored = None
+        self.re_floating = None
+        if anchored:
+            self.re_anchored = re.compile("|".join(anchored), flags=re.IGNORECASE)
+        if floating:
+            self.re_floating = re.compile("|".join(floating), flags=re.IGNORECASE)
+
+    def match(self, title):
+        m = None
+        if self.re_anchored:
+            m = self.re_anchored.match(title)
+        if not m and self.re_floating:
+            m = self.re_floating.search(title)
+        if m:
+            return self.patterns[int(m.lastgroup[1:])]
+        return None
+
+
+title_suppressors = {}
+
+def get_title_suppressor(suppressed_titles):
+    key = tuple(suppressed_titles)
+    if key not in title_suppressors:
+        title_suppressors[key] = TitleSuppressor(key)
+    return title_suppressors[key]
+
+
 def suppress_title(record, suppressed_titles):
+    """
+    Returns the suppressed-title pattern matching the record's English
+    title, or None if there is no match.
+    """
     title = record.get('title', {}).get('textEnglish', None)
-    if title:
-        for dtitle in suppressed_titles:
-            if re.search(dtitle, title, flags=re.IGNORECASE):
-                return True
+    if title and suppressed_titles:
+        return get_title_suppressor(suppressed_titles).match(title)
+
+def iter_doi_bibcode(infile, on_error=None):
+    """
+    Generator yielding (doi, bibcode) pairs from a tab-separated
+    bibcode/DOI links file (e.g. all.links), one line at a time.  on_error,
+    if given, is called with (line number, exception) for each malformed
+    line, which is skipped; otherwise the exception is raised.
+    """
+    with open(infile, "r") as fd:
+        for (lineno, l) in enumerate(fd, 1):
+            try:
+                (bibcode, doi) = l.strip().split("\t")
+            except ValueError as err:
+                if not on_error:
+                    raise
+                on_error(lineno, err)
+                continue
+            if "\.tmp" not in bibcode:
+                yield (doi, bibcode)
+
 
 def load_doi_bibcode(infile):
     doi_bibc = {}
     try:
-        with open(infile, "r") as fd:
-            for l in fd.readlines():
-                (bibcode, doi) = l.strip().split("\t")
-                if "\.tmp" not in bibcode:
-                    if not doi_bibc.get(doi, None):
-                        doi_bibc[doi] = bibcode
-                    # else:
-                    #     print("WARNING: multiple canonical bibs for one DOI: %s\t%s\t%s" % (doi, doi_bibc[doi], bibcode))
+        for (doi, bibcode) in iter_doi_bibcode(infile):
+            if not doi_bibc.get(doi, None):
+                doi_bibc[doi] = bibcode
+            # else:
+            #     print("WARNING: multiple canonical bibs for one DOI: %s\t%s\t%s" % (doi, doi_bibc[doi], bibcode))
     except Exception as err:
         print("Failed to load doi-bibcode mapping: %s" % err)
     return doi_bibc
 
+
+def _scan_parts(dirpath, parts):
+    # walks dirpath matching one glob segment per directory level, in the
+    # same way as glob.iglob(pattern, recursive=True)
+    head = parts[0]
+    rest = parts[1:]
+    if head == '**':
+        if rest:
+            for f in _scan_parts(dirpath, rest):
+                yield f
+        recurse = parts
+    else:
+        recurse = rest
+    try:
+        entries = os.scandir(dirpath or '.')
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.') and not head.startswith('.'):
+                continue
+            path = os.path.join(dirpath, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if head == '**':
+                if is_dir:
+                    for f in _scan_parts(path, recurse):
+                        yield f
+                    continue
+                elif rest:
+                    continue
+            elif not fnmatch(entry.name, head):
+                continue
+            elif rest:
+                if is_dir:
+                    for f in _scan_parts(path, rest):
+                        yield f
+                continue
+            if not is_dir:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield (path, stat)
+
+
+def find_files(pattern, since=None, on_old=None):
+    """
+    Generator yielding (path, stat_result) for each file matching the
+    (recursive) glob pattern, optionally only those modified in the last
+    `since` days.  Files are yielded as they are found while walking the
+    tree with os.scandir, and the age test uses the DirEntry's stat.
+    on_old, if given, is called with (path, stat_result) for each matching
+    file left out by the age test.
+    """
+    cutoff = None
+    if since:
+        cutoff = time.time() - float(since) * 86400.
+    if not has_magic(pattern):
+        try:
+            stat = os.stat(pattern)
+        except OSError:
+            return
+        if cutoff is None or stat.st_mtime >= cutoff:
+            yield (pattern, stat)
+        elif on_old:
+            on_old(pattern, stat)
+        return
+    parts = pattern.split(os.sep)
+    basedir = []
+    while parts and not has_magic(parts[0]):
+        basedir.append(parts.pop(0))
+    if basedir == ['']:
+        basedir = os.sep
+    else:
+        basedir = os.sep.join(basedir)
+    parts = [p for p in parts if p]
+    if parts:
+        for (path, stat) in _scan_parts(basedir, parts):
+            if cutoff is None or stat.st_mtime >= cutoff:
+                yield (path, stat)
+            elif on_old:
+                on_old(path, stat)
+
+
+def open_stream(path):
+    """
+    Opens path (or stdin, for "-") for reading text line by line,
+    decompressing it on the fly if it starts with the gzip magic number.
+    """
+    if path == "-":
+        raw = sys.stdin.buffer
+        if not hasattr(raw, "peek"):
+            raw = io.BufferedReader(raw)
+    else:
+        raw = open(path, "rb")
+    if raw.peek(2)[:2] == b"\x1f\x8b":
+        raw = gzip.GzipFile(fileobj=raw, mode="rb")
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def iter_jsonl(path, on_error=None, numbered=False):
+    """
+    Generator yielding the object on each line of a JSON lines file (or
+    stdin, for "-"), reading one line at a time, or (line number, object)
+    if numbered is set.  Blank lines are skipped; on_error, if given, is
+    called with (line number, exception) for each line that is not valid
+    JSON, and otherwise the exception is raised.
+    """
+    with open_stream(path) as fin:
+        for (lineno, line) in enumerate(fin, 1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as err:
+                if not on_error:
+                    raise
+                on_error(lineno, err)
+                continue
+            if numbered:
+                yield (lineno, obj)
+            else:
+                yield obj
+
+
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".zip")
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+re_glob_part = re.compile(r"\*\*/|\*\*|\*|\?|\[!?\]?[^\]]*\]|[^*?\[]+|\[")
+member_patterns = {}
+
+def _member_regex(pattern):
+    # glob to regex, with * and ? stopping at "/" and ** crossing it
+    regex = member_patterns.get(pattern, None)
+    if regex is None:
+        out = []
+        for part in re_glob_part.findall(pattern):
+            if part == "**/":
+                out.append("(?:.*/)?")
+            elif part == "**":
+                out.append(".*")
+            elif part == "*":
+                out.append("[^/]*")
+            elif part == "?":
+                out.append("[^/]")
+            elif part.startswith("[") and len(part) > 1:
+                body = part[1:-1]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[%s]" % body.replace("\\", "\\\\"))
+            else:
+                out.append(re.escape(part))
+        regex = re.compile("".join(out) + r"\Z", re.S)
+        member_patterns[pattern] = regex
+    return regex
+
+
+def match_member(name, pattern):
+    """
+    Glob match for archive member names: a pattern with no "/" is matched
+    against the last part of the name, any other against the whole name,
+    with "**" matching any number of directories.  Hidden members (e.g.
+    "._foo.xml" files added by macOS) only match a pattern starting with ".".
+    """
+    basename = name.rsplit("/", 1)[-1]
+    if basename.startswith(".") and not pattern.rsplit("/", 1)[-1].startswith("."):
+        return False
+    if "/" not in pattern:
+        name = basename
+    return _member_regex(pattern).match(name) is not None
+
+
+def iter_archive(path, pattern=None, on_error=None):
+    """
+    Generator yielding (member name, text) for each regular file in a tar
+    (optionally compressed) or zip archive whose name matches the glob
+    pattern (see match_member; by default every file that isn't hidden).
+    Tar archives are read as a stream, one member at a time.  on_error, if
+    given, is called with (member name, exception) for each member that
+    can't be read, and otherwise the exception is raised.
+    """
+    pattern = pattern or "*"
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as fz:
+            for info in fz.infolist():
+                if info.is_dir() or not match_member(info.filename, pattern):
+                    continue
+                try:
+                    with fz.open(info) as fb:
+                        text = io.TextIOWrapper(fb).read()
+                except Exception as err:
+                    if not on_error:
+                        raise
+                    on_error(info.filename, err)
+                    continue
+                yield (info.filename, text)
+    else:
+        with tarfile.open(path, mode="r|*") as ft:
+            for member in ft:
+                if not member.isfile() or not match_member(member.name, pattern):
+                    continue
+                try:
+                    # a tar stream can't be wrapped directly, as it
+                    # isn't seekable
+                    text = io.TextIOWrapper(io.BytesIO(ft.extractfile(member).read())).read()
+                except Exception as err:
+                    if not on_error:
+                        raise
+                    on_error(member.name, err)
+                    continue
+                yield (member.name, text)
+
+
+_umask = None
+
+
+def default_file_mode():
+    # the mode open() gives a new file: 0666 less the process umask, which
+    # can only be read by setting it, so it is only done once
+    global _umask
+    if _umask is None:
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return 0o666 & ~_umask
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+@contextlib.contextmanager
+def replacing(path, fsync=False):
+    """
+    Yields the path of a temporary file next to path, and renames it over
+    path once the block completes, so readers only ever see the old file or
+    the new one; if the block raises, the temporary file is removed.  The
+    new file keeps the mode of the one it replaces, or gets the default
+    mode if there was none.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    (fd, tmpfile) = tempfile.mkstemp(dir=dirname, prefix=".%s." % os.path.basename(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmpfile
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = default_file_mode()
+        os.chmod(tmpfile, mode)
+        if fsync:
+            fd = os.open(tmpfile, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(tmpfile, path)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w", fsync=False, **kwargs):
+    # open() on a file that replaces path when it is closed
+    with replacing(path, fsync=fsync) as tmpfile:
+        with open(tmpfile, mode, **kwargs) as fout:
+            yield fout
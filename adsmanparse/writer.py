@@ -0,0 +1,172 @@
+"""
+writer.py: a run-scoped output sink for classic tagged records.  The output
+file is opened once per run, written through a buffer that is flushed when
+it fills and at regular intervals.  The run appends to the output in
+place, and leaves a marker file next to it (".<name>.writing") holding the
+size of the output it vouches for: the size when the run started, and
+after each sync() the size synced to disk.  A run that finds the marker of
+one that died cuts the output back to that size before it appends, so a
+crash never leaves anything behind that a checkpoint or the manifest
+doesn't know about.  A run resuming from a checkpoint has already cut the
+output back to it, and carries the old marker forward instead.  A path of
+"-" streams the records to stdout instead, flushing after every
+`flush_records` of them so that a reader at the other end of a pipe gets
+them as they come.
+"""
+import os
+import time
+from adsmanparse import utils
+
+STDOUT = "-"
+
+
+class TaggedWriterException(Exception):
+    pass
+
+
+class TaggedWriter(object):
+
+    def __init__(self, path, buffer_size=1048576, flush_interval=30,
+                 fsync=False, resume=False, flush_records=0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.stream = (path == STDOUT)
+        # there is nothing to sync or rename on a stream
+        self.fsync = fsync and not self.stream
+        # set when the output was already cut back to a checkpoint
+        self.resume = resume
+        self.nrecords = 0
+        self._fout = None
+        self._marker = None
+        self._last_flush = None
+        # bytes dropped from the output, left by an interrupted run
+        self.recovered = 0
+
+    def open(self):
+        try:
+            if self.stream:
+                # a descriptor of our own, so closing it leaves sys.stdout be
+                self._fout = os.fdopen(os.dup(1), "w", buffering=self.buffer_size)
+            else:
+                start = self._recover()
+                self._fout = open(self.path, "a", buffering=self.buffer_size)
+                if start is None:
+                    start = self._fout.tell()
+                self._marker = self._marker_path()
+                self._write_marker(min(start, self._fout.tell()))
+            self._last_flush = time.time()
+        except Exception as err:
+            self._discard()
+            raise TaggedWriterException("Failed to open output file %s: %s" % (self.path, err))
+        return self
+
+    def _marker_path(self):
+        (dirname, basename) = os.path.split(os.path.abspath(self.path))
+        return os.path.join(dirname, ".%s.writing" % basename)
+
+    def _write_marker(self, offset):
+        with utils.atomic_open(self._marker, fsync=self.fsync) as fm:
+            fm.write("%s %s\n" % (offset, os.getpid()))
+
+    def _recover(self):
+        # cuts the output back to where a run that never finished started
+        # writing it, setting self.recovered to the number of bytes dropped;
+        # when resuming, nothing is dropped, and the offset the unfinished
+        # run started at is returned instead
+        marker = self._marker_path()
+        try:
+            with open(marker) as fm:
+                (offset, pid) = [int(x) for x in fm.read().split()]
+        except FileNotFoundError:
+            return None
+        if pid != os.getpid() and utils.pid_alive(pid):
+            raise TaggedWriterException("Output file %s is being written by process %s" % (self.path, pid))
+        if self.resume:
+            return offset
+        ndropped = 0
+        if os.path.isfile(self.path):
+            ndropped = max(os.path.getsize(self.path) - offset, 0)
+            if ndropped:
+                os.truncate(self.path, offset)
+        os.remove(marker)
+        if ndropped:
+            print("Dropped %s bytes written to %s by an interrupted run" % (ndropped, self.path))
+        self.recovered = ndropped
+        return None
+
+    def write(self, record):
+        try:
+            self._fout.write(record)
+            self.nrecords += 1
+            if self.flush_records and not self.nrecords % self.flush_records:
+                self.flush()
+            elif self.flush_interval and (time.time() - self._last_flush) >= self.flush_interval:
+                self.flush()
+        except BrokenPipeError:
+            raise TaggedWriterException("Output (%s) was closed by its reader" % ("stdout" if self.stream else self.path))
+
+    def flush(self, sync=False):
+        self._fout.flush()
+        if sync and not self.stream:
+            os.fsync(self._fout.fileno())
+        self._last_flush = time.time()
+
+    def tell(self):
+        return self._fout.tell()
+
+    def sync(self):
+        # flushes and fsyncs everything written so far, and returns the size
+        # of the file on disk.  Only whole records are ever written, so the
+        # output up to here is kept even if the run dies later on: callers
+        # (checkpoints, the manifest) count on it being there
+        self.flush(sync=True)
+        size = os.fstat(self._fout.fileno()).st_size
+        if self._marker:
+            self._write_marker(size)
+        return size
+
+    def close(self):
+        if self._fout is None:
+            return
+        if self.stream:
+            try:
+                self._fout.close()
+            except BrokenPipeError:
+                pass
+            self._fout = None
+            return
+        try:
+            self.flush(sync=self.fsync)
+            self._fout.close()
+            self._fout = None
+            if self._marker:
+                # the run is complete
+                os.remove(self._marker)
+                self._marker = None
+                if self.fsync:
+                    dirfd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+                    try:
+                        os.fsync(dirfd)
+                    finally:
+                        os.close(dirfd)
+        except Exception as err:
+            raise TaggedWriterException("Failed to close output file %s: %s" % (self.path, err))
+
+    def _discard(self):
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
+        if self._marker and os.path.exists(self._marker):
+            os.remove(self._marker)
+        self._marker = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # everything handed to write() is a complete record, so what was
+        # written before an exception is still committed
+        self.close()
+        return False
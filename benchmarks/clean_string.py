@@ -0,0 +1,90 @@
+"""
+clean_string.py: checks that ClassicSerializer._clean_string gives
+byte-identical output to the original implementation (named_entities and
+four re.sub passes) on every text node, and every whole file, in the test
+corpus, and compares their throughput.
+
+    python benchmarks/clean_string.py [-n REPEAT] [files ...]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from glob import glob
+from lxml import etree
+from namedentities import named_entities
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+from adsmanparse import classic_serializer
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(__file__), "..", "adsmanparse",
+                             "tests", "data", "input", "*.xml")
+
+
+def clean_string_orig(data):
+    # the original implementation, for comparison
+    data = named_entities(data)
+    data = re.sub(r"&[rl]squo;", "\'", data)
+    data = re.sub(r"&[rl]dquo;", "\"", data)
+    data = re.sub(r"&nbsp;", " ", data)
+    data = re.sub(r"&zwnj;", " ", data)
+    return data
+
+
+def corpus_strings(files):
+    strings = []
+    parser = etree.XMLParser(recover=True, resolve_entities=False)
+    for f in files:
+        with open(f, "r") as fin:
+            raw = fin.read()
+        strings.append(raw)
+        try:
+            tree = etree.fromstring(raw.encode("utf-8"), parser=parser)
+        except Exception as err:
+            continue
+        if tree is None:
+            continue
+        for e in tree.iter(etree.Element):
+            text = "".join(e.itertext()).strip()
+            if text:
+                strings.append(text)
+    return strings
+
+
+def time_it(func, strings, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for s in strings:
+            func(s)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark ClassicSerializer._clean_string")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=3)
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    strings = corpus_strings(args.files or sorted(glob(DEFAULT_INPUT)))
+    clean_string = classic_serializer.ClassicSerializer()._clean_string
+
+    mismatch = 0
+    for s in strings:
+        if clean_string(s) != clean_string_orig(s):
+            mismatch += 1
+            print("MISMATCH: %r" % s[:80])
+
+    nbytes = sum(len(s.encode("utf-8")) for s in strings) * args.repeat
+    t_orig = time_it(clean_string_orig, strings, args.repeat)
+    t_new = time_it(clean_string, strings, args.repeat)
+    print("strings: %s, mismatches: %s" % (len(strings), mismatch))
+    print("original:     %8.1f MB/s" % (nbytes / t_orig / 1e6))
+    print("_clean_string: %7.1f MB/s" % (nbytes / t_new / 1e6))
+    print("speedup:      %8.1fx" % (t_orig / t_new))
+    return mismatch
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
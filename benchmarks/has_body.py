@@ -0,0 +1,60 @@
+"""
+has_body.py: compare utils.has_body against the original BeautifulSoup
+body test (utils.has_body_soup) over the bundled test corpus.
+
+    python benchmarks/has_body.py [-n REPEAT] [files ...]
+"""
+import argparse
+import os
+import sys
+import time
+from glob import glob
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+from adsmanparse import utils
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(__file__), "..", "adsmanparse",
+                             "tests", "data", "input", "*.xml")
+
+
+def time_it(func, docs, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for d in docs:
+            func(d)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark utils.has_body")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=5)
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob(DEFAULT_INPUT))
+    docs = []
+    for f in files:
+        with open(f, "r") as fin:
+            docs.append((f, fin.read()))
+
+    mismatch = 0
+    for (f, d) in docs:
+        if utils.has_body(d) != utils.has_body_soup(d):
+            mismatch += 1
+            print("MISMATCH: %s" % f)
+
+    data = [d for (f, d) in docs]
+    t_soup = time_it(utils.has_body_soup, data, args.repeat)
+    t_scan = time_it(utils.has_body, data, args.repeat)
+    nrec = len(data) * args.repeat
+    print("files: %s, repeats: %s, mismatches: %s" % (len(data), args.repeat, mismatch))
+    print("has_body_soup: %8.3f ms/record" % (1000. * t_soup / nrec))
+    print("has_body:      %8.3f ms/record" % (1000. * t_scan / nrec))
+    if t_scan:
+        print("speedup:       %8.1fx" % (t_soup / t_scan))
+    return mismatch
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,166 @@
+"""
+stages.py: per-stage benchmark of the run.py pipeline over the bundled test
+corpus (APS, IOP, OUP and AIP files).  Each record is run through every
+stage separately -- file read, utils.has_body, the adsingestp parse, each
+Translator._get_* step, ClassicSerializer.serialize and the write -- and
+the mean and 95th percentile time of each stage is reported, along with
+records per second for the whole pipeline.
+
+Results can be saved as a baseline, and compared against one: any stage
+whose mean time has grown by more than --threshold is flagged as a
+regression, and the exit status is 1.
+
+    python benchmarks/stages.py [-n REPEAT] [-t FILE_TYPE]
+                                [--save-baseline FILE] [--baseline FILE]
+                                [--threshold FRACTION] [files ...]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from glob import glob
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, PROJ_HOME)
+
+import run
+from adsmanparse import classic_serializer, translator, utils, writer
+
+DEFAULT_INPUT = os.path.join(PROJ_HOME, "adsmanparse", "tests", "data", "input", "*.xml")
+
+# the Translator steps, in the order Translator.translate calls them
+TRANSLATE_STEPS = [("title", "_get_title", {}),
+                   ("abstract", "_get_abstract", {}),
+                   ("keywords", "_get_keywords", {}),
+                   ("auths_affils", "_get_auths_affils", {}),
+                   ("date", "_get_date", {}),
+                   ("references", "_get_references", {}),
+                   ("properties", "_get_properties", {"parsedfile": False}),
+                   ("publication", "_get_publication", {}),
+                   ("comments", "_get_comments", {}),
+                   ("bibcode", "_get_bibcode", {}),
+                   ("copyright", "_get_copyright", {})]
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.times = {}
+        self.order = []
+
+    def add(self, stage, seconds):
+        if stage not in self.times:
+            self.times[stage] = []
+            self.order.append(stage)
+        self.times[stage].append(seconds)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def summary(self):
+        summary = {}
+        for stage in self.order:
+            t = sorted(self.times[stage])
+            summary[stage] = {"mean": sum(t) / len(t),
+                              "p95": t[min(len(t) - 1, int(0.95 * len(t)))],
+                              "count": len(t)}
+        return summary
+
+
+def read_file(f):
+    with open(f, "r") as fin:
+        return fin.read()
+
+
+def run_record(timer, f, ftype, xlator, seri, output):
+    data = timer.time("read", read_file, f)
+    timer.time("has_body", utils.has_body, data)
+    parser = run.get_parser(ftype)
+    parser.__init__()
+    if ftype == "nlm":
+        parsed = timer.time("parse", parser.parse, data, bsparser="lxml-xml")
+    else:
+        parsed = timer.time("parse", parser.parse, data)
+    xlator.reset(data=parsed)
+    start = time.perf_counter()
+    for (stage, method, kwargs) in TRANSLATE_STEPS:
+        timer.time("translate." + stage, getattr(xlator, method), **kwargs)
+    timer.add("translate", time.perf_counter() - start)
+    tagged = timer.time("serialize", seri.serialize, xlator.output)
+    timer.time("write", output.write, "%s\n" % tagged.text)
+
+
+def compare(summary, baseline, threshold):
+    regressions = []
+    for (stage, stats) in summary.items():
+        base = baseline.get("stages", {}).get(stage, None)
+        if base and base["mean"] > 0:
+            change = stats["mean"] / base["mean"] - 1.
+            if change > threshold:
+                regressions.append((stage, base["mean"], stats["mean"], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("Per-stage benchmark of the run.py pipeline")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=5)
+    parser.add_argument("-t", "--file_type", dest="file_type", default="jats")
+    parser.add_argument("--save-baseline", dest="save_baseline", default=None)
+    parser.add_argument("--baseline", dest="baseline", default=None)
+    parser.add_argument("--threshold", dest="threshold", type=float, default=0.10,
+                        help="Fractional slowdown of a stage's mean time flagged as a regression")
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob(DEFAULT_INPUT))
+    timer = StageTimer()
+    xlator = translator.Translator(doibib={})
+    seri = classic_serializer.ClassicSerializer()
+    nrec = 0
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with writer.TaggedWriter(os.path.join(tmpdir, "stages.tag")) as output:
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                for f in files:
+                    try:
+                        run_record(timer, f, args.file_type, xlator, seri, output)
+                        nrec += 1
+                    except Exception as err:
+                        failed += 1
+                        if i == 0:
+                            print("FAILED %s: %s" % (f, err))
+            elapsed = time.perf_counter() - start
+
+    summary = timer.summary()
+    print("%-26s %10s %10s %8s" % ("stage", "mean (ms)", "p95 (ms)", "count"))
+    for (stage, stats) in summary.items():
+        print("%-26s %10.3f %10.3f %8d" % (stage, 1000. * stats["mean"], 1000. * stats["p95"], stats["count"]))
+    rate = nrec / elapsed if elapsed else 0.
+    print("records: %s, failed: %s, %.1f records/s" % (nrec, failed, rate))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fb:
+            json.dump({"stages": summary, "records_per_second": rate}, fb, indent=2)
+        print("Saved baseline to %s" % args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline, "r") as fb:
+            baseline = json.load(fb)
+        regressions = compare(summary, baseline, args.threshold)
+        for (stage, old, new, change) in regressions:
+            print("REGRESSION %-26s %10.3f -> %10.3f ms (+%.0f%%)" % (stage, 1000. * old, 1000. * new, 100. * change))
+        if regressions:
+            return 1
+        print("No stage slower than the baseline by more than %.0f%%." % (100. * args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+startup.py: measures run.py startup cost -- the time to import run.py, and
+the time from process start until the first record has been processed
+(a single-file run over one of the bundled test files).
+
+    python benchmarks/startup.py [-n REPEAT] [-t FILE_TYPE] [file]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_INPUT = os.path.join(PROJ_HOME, "adsmanparse", "tests", "data", "input",
+                             "iop_apj.xml")
+
+
+def wall_time(cmd):
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=PROJ_HOME, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def report(label, times):
+    times = sorted(times)
+    print("%-24s min %7.3f s   median %7.3f s" % (label, times[0], times[len(times) // 2]))
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark run.py startup")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=5)
+    parser.add_argument("-t", "--file_type", dest="file_type", default="jats")
+    parser.add_argument("file", nargs="?", default=DEFAULT_INPUT)
+    args = parser.parse_args()
+
+    python = sys.executable
+    report("interpreter", [wall_time([python, "-c", "pass"]) for i in range(args.repeat)])
+    report("import run", [wall_time([python, "-c", "import run"]) for i in range(args.repeat)])
+
+    first = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = os.path.join(tmpdir, "startup.tag")
+        for i in range(args.repeat):
+            first.append(wall_time([python, "run.py", "-p", args.file,
+                                    "-t", args.file_type, "-f", outfile]))
+    report("first record", first)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+titles.py: compares utils.suppress_title (one precompiled matcher) with the
+original loop of re.search calls over config.DEPRECATED_TITLES, checking
+that both suppress the same titles.
+
+    python benchmarks/titles.py [-n REPEAT]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+
+import config
+from adsmanparse import utils
+
+SAMPLE_TITLES = [
+    "Index",
+    "Index to volume 42",
+    "Author Index",
+    "Editorial Board",
+    "Cover 2",
+    "Contents",
+    "Graphical abstract",
+    "   ",
+    "[Front matter]",
+    "OFC",
+    "IBC and other things",
+    "Information for authors and readers",
+    "Call for papers: Forthcoming meeting in Boston",
+    "An advertisement for a telescope",
+    "Back cover",
+    "Title Page",
+    "Effects of Active Galactic Nucleus Feedback on Cold Gas Depletion and Quenching of Central Galaxies",
+    "The abstract nature of indexing: contents of galaxy clusters",
+    "Coverage of the Southern sky with the Cover Survey",
+    "A Masterful Analysis of the Masthead Nebula",
+    "Spectroscopy of the Blazar OJ 287 in outburst",
+    "Quantum entanglement in optical lattices with long-range interactions",
+    "Frontmatter-free inference for cosmological parameters",
+    "Patent report on lasers",
+    "Diary of an observing run",
+    "Diary",
+]
+
+
+def suppress_title_loop(record, suppressed_titles):
+    # the original implementation, for comparison
+    title = record.get('title', {}).get('textEnglish', None)
+    if title:
+        for dtitle in suppressed_titles:
+            if re.search(dtitle, title, flags=re.IGNORECASE):
+                return True
+
+
+def time_it(func, records, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for r in records:
+            func(r, config.DEPRECATED_TITLES)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark utils.suppress_title")
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    records = [{'title': {'textEnglish': t}} for t in SAMPLE_TITLES]
+    mismatch = 0
+    for r in records:
+        old = bool(suppress_title_loop(r, config.DEPRECATED_TITLES))
+        new = utils.suppress_title(r, config.DEPRECATED_TITLES)
+        if old != bool(new):
+            mismatch += 1
+            print("MISMATCH: %r" % r['title']['textEnglish'])
+
+    t_loop = time_it(suppress_title_loop, records, args.repeat)
+    t_comb = time_it(utils.suppress_title, records, args.repeat)
+    ntitles = len(records) * args.repeat
+    print("patterns: %s, titles: %s, mismatches: %s" % (len(config.DEPRECATED_TITLES), len(records), mismatch))
+    print("re.search loop:    %8.2f us/title" % (1e6 * t_loop / ntitles))
+    print("combined matcher:  %8.2f us/title" % (1e6 * t_comb / ntitles))
+    print("speedup:           %8.1fx" % (t_loop / t_comb))
+    return mismatch
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -1,44 +1,99 @@
 import argparse
+import hashlib
+import importlib
+import io
 import json
+import logging
+import multiprocessing
 import os
-import re
-from adsenrich.references import ReferenceWriter
-from adsingestp.parsers.crossref import CrossrefParser
-from adsingestp.parsers.jats import JATSParser
-from adsingestp.parsers.datacite import DataciteParser
-from adsingestp.parsers.dubcore import DublinCoreParser
-from adsingestp.parsers.elsevier import ElsevierParser
-from adsingestp.parsers.adsfeedback import ADSFeedbackParser
-from adsingestp.parsers.copernicus import CopernicusParser
-from adsingestp.parsers.wiley import WileyParser
-from adsmanparse import translator, doiharvest, classic_serializer, utils, counter
-from adsputils import load_config, setup_logging
-from datetime import datetime, timedelta
-from glob import iglob
-
-PARSER_TYPES = {'jats': JATSParser(),
-                'dc': DataciteParser(),
-                'cr': CrossrefParser(),
-                'nlm': JATSParser(),
-                'elsevier': ElsevierParser(),
-                'feedback': ADSFeedbackParser(),
-                'copernicus': CopernicusParser(),
-                'wiley': WileyParser(),
-                'dubcore': DublinCoreParser(),
+import sys
+import tempfile
+import threading
+import time
+from adsmanparse import translator, doiharvest, classic_serializer, utils, counter, doimap, writer, manifest, checkpoint, profiling, metrics, refstage, bgio
+
+# parsers are imported and instantiated on first use, see get_parser
+PARSER_TYPES = {'jats': ('adsingestp.parsers.jats', 'JATSParser'),
+                'dc': ('adsingestp.parsers.datacite', 'DataciteParser'),
+                'cr': ('adsingestp.parsers.crossref', 'CrossrefParser'),
+                'nlm': ('adsingestp.parsers.jats', 'JATSParser'),
+                'elsevier': ('adsingestp.parsers.elsevier', 'ElsevierParser'),
+                'feedback': ('adsingestp.parsers.adsfeedback', 'ADSFeedbackParser'),
+                'copernicus': ('adsingestp.parsers.copernicus', 'CopernicusParser'),
+                'wiley': ('adsingestp.parsers.wiley', 'WileyParser'),
+                'dubcore': ('adsingestp.parsers.dubcore', 'DublinCoreParser'),
                }
 
+parsers = {}
+
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "./"))
-conf = load_config(proj_home=proj_home)
-logger = setup_logging(
-    "run.py",
-    proj_home=proj_home,
-    level=conf.get("LOGGING_LEVEL", "INFO"),
-    attach_stdout=conf.get("LOG_STDOUT", False),
-)
 
-doi_bibcode_dict = utils.load_doi_bibcode(conf.get("DOI_BIBCODE_MAP", "./all.links"))
+start_time = time.time()
+
+# set by setup(), which main() calls before doing anything else
+conf = {}
+logger = logging.getLogger("run.py")
+doi_bibcode_dict = {}
+counter_datafile = "./counter.json"
+counter_database = "./counter.db"
+
+
+def setup():
+    global conf, logger, doi_bibcode_dict, counter_datafile, counter_database
+    from adsputils import load_config, setup_logging
+    conf = load_config(proj_home=proj_home)
+    logger = setup_logging(
+        "run.py",
+        proj_home=proj_home,
+        level=conf.get("LOGGING_LEVEL", "INFO"),
+        attach_stdout=conf.get("LOG_STDOUT", False),
+    )
+
+    # the mapping is only loaded by the first Translator._get_bibcode lookup
+    doi_bibcode_dict = doimap.LazyDoiBibcodeMap(conf.get("DOI_BIBCODE_MAP", "./all.links"),
+                                                snapshot=conf.get("DOI_BIBCODE_INDEX", None))
+
+    counter_datafile = conf.get("COUNTER_DATAFILE", "./counter.json")
+    counter_database = conf.get("COUNTER_DATABASE", "./counter.db")
+
+
+# set by main() when profiling or collecting metrics (and by _init_worker in
+# worker processes); stage() and count() are no-ops otherwise
+profiler = None
+run_metrics = None
+
+def stage(name):
+    if run_metrics is None:
+        if profiler is None:
+            return profiling.NULL_STAGE
+        return profiler.stage(name)
+    if profiler is None:
+        return run_metrics.stage(name)
+    return run_metrics.stage(name, wrapped=profiler.stage(name))
+
+
+def count(name, value=1, **labels):
+    if run_metrics is not None:
+        run_metrics.inc(name, value, **labels)
+
+
+# side outputs (references, harvested XML) are written by these threads
+# when set, see open_background
+background = None
 
-counter_datafile = conf.get("COUNTER_DATAFILE", "./counter.json")
+def in_background(func, *args, **kwargs):
+    if background is None:
+        return func(*args, **kwargs)
+    background.submit(func, *args, **kwargs)
+
+
+def get_parser(ptype):
+    parser = parsers.get(ptype, None)
+    if not parser and ptype in PARSER_TYPES:
+        (module, classname) = PARSER_TYPES[ptype]
+        parser = getattr(importlib.import_module(module), classname)()
+        parsers[ptype] = parser
+    return parser
 
 def get_args():
 
@@ -77,14 +132,20 @@ def get_args():
                         dest='output_file',
                         action='store',
                         default='./doi.tag',
-                        help='File that tagged format will be written to')
+                        help='File that tagged format will be written to, or - for stdout')
 
     parser.add_argument('-p',
                         '--proc_path',
                         dest='proc_path',
                         action='store',
                         default=None,
-                        help='Path to files or list of files')
+                        help='Path to files or list of files, which may include tar or zip archives')
+
+    parser.add_argument('--members',
+                        dest='members',
+                        action='store',
+                        default="*.xml",
+                        help='Glob for the files to read from archives in --proc_path, e.g. "*.nlm" or "**/xml/*.xml" (default "*.xml")')
 
     parser.add_argument('-a',
                         '--age',
@@ -93,6 +154,24 @@ def get_args():
                         default=None,
                         help='Age (in days) of oldest files in --proc_path to process')
 
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        action='store_true',
+                        default=False,
+                        help='Only process files in --proc_path that are new or changed since they were last processed')
+
+    parser.add_argument('--manifest',
+                        dest='manifest',
+                        action='store',
+                        default=None,
+                        help='Manifest recording the processed files and their outcomes (default MANIFEST_FILE)')
+
+    parser.add_argument('--jsonl',
+                        dest='jsonl',
+                        action='store',
+                        default=None,
+                        help='Read records of {"name", "type", "data"} from a JSON lines file (gzip allowed), or - for stdin')
+
     parser.add_argument('-t',
                         '--file_type',
                         dest='file_type',
@@ -163,10 +242,113 @@ def get_args():
                         default=False,
                         help='Use a running counter in place of page')
 
+    parser.add_argument('-N',
+                        '--workers',
+                        dest='workers',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes used to parse and translate records')
+
+    parser.add_argument('-O',
+                        '--ordered',
+                        dest='ordered',
+                        action='store_true',
+                        default=False,
+                        help='With --workers, write tagged records in input order')
+
+    parser.add_argument('--harvest_workers',
+                        dest='harvest_workers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='Number of DOIs to fetch concurrently with -d/-l')
+
+    parser.add_argument('--no_cache',
+                        dest='no_cache',
+                        action='store_true',
+                        default=False,
+                        help='Always fetch DOIs from the network, bypassing the DOI record cache')
+
+    parser.add_argument('--checkpoint_every',
+                        dest='checkpoint_every',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Save a checkpoint every N records, so an interrupted run can be resumed')
+
+    parser.add_argument('--resume',
+                        dest='resume',
+                        action='store_true',
+                        default=False,
+                        help='Resume an interrupted run from its last checkpoint')
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default=None,
+                        help='Profile the run with cProfile, writing PROFILE.pstats and a summary to PROFILE.txt')
+
+    parser.add_argument('--profile_memory',
+                        dest='profile_memory',
+                        action='store_true',
+                        default=False,
+                        help='Trace memory with tracemalloc and report the peak memory of each stage')
+
+    parser.add_argument('--metrics',
+                        dest='metrics',
+                        action='store',
+                        default=None,
+                        help='Write run metrics to METRICS.prom (Prometheus textfile) and METRICS.json (default METRICS_PREFIX)')
+
+    parser.add_argument('--metrics_interval',
+                        dest='metrics_interval',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='Also write the metrics every N seconds during the run (0 to write them only at the end)')
+
+    parser.add_argument('--buffer_size',
+                        dest='buffer_size',
+                        action='store',
+                        type=int,
+                        default=1048576,
+                        help='Size in bytes of the output file buffer')
+
+    parser.add_argument('--flush_interval',
+                        dest='flush_interval',
+                        action='store',
+                        type=float,
+                        default=30,
+                        help='Seconds between flushes of the output file (0 to flush only when the buffer is full)')
+
+    parser.add_argument('--flush_records',
+                        dest='flush_records',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Flush the output after every N records (default 1 when writing to stdout, otherwise 0 for never)')
+
+    parser.add_argument('--fsync',
+                        dest='fsync',
+                        action='store_true',
+                        default=False,
+                        help='fsync the output file when the run finishes')
 
     args = parser.parse_args()
     return args
 
+def get_counter_page(bibstem, year):
+    # COUNTER_DATABASE=None keeps using the JSON counter file
+    if not counter_database:
+        return counter.Counter().get_page(bibstem, year, counter_datafile)
+    sqlcounter = counter.SQLiteCounter()
+    if not os.path.exists(counter_database) and os.path.isfile(counter_datafile):
+        nrows = sqlcounter.migrate_from_json(counter_datafile, counter_database)
+        logger.info("Migrated %s counters from %s to %s" % (nrows, counter_datafile, counter_database))
+    return sqlcounter.get_page(bibstem, year, counter_database)
+
+
 def use_counter_page(output, bibstem):
     try:
         bibcode = output.get("bibcode", None)
@@ -176,9 +358,7 @@ def use_counter_page(output, bibstem):
             year = str(bibcode[0:4])
             page = bibcode[14:18]
             if page == "....":
-                page = str(counter.Counter().get_page(bibstem,
-                                                      year,
-                                                      counter_datafile))
+                page = str(get_counter_page(bibstem, year))
                 page = page.rjust(4, ".")
             bibcode_new = bibcode[0:14]+page+bibcode[18]
             if bibcode_new != bibcode:
@@ -244,59 +424,91 @@ def move_doiid(record):
     return record
 
 
+# one Translator and one ClassicSerializer per process, see get_taggers
+taggers = None
+
+def get_taggers(args):
+    global taggers
+    if taggers is None:
+        try:
+            xlator = translator.Translator(doibib=doi_bibcode_dict, idpage=args.id_page, doipage=args.doi_page)
+        except Exception as err:
+            raise Exception("translator instantiation failed: %s" % err)
+        try:
+            seri = classic_serializer.ClassicSerializer(tag_refs=args.tagged_refs)
+        except Exception as err:
+            raise Exception("serializer instantiation failed: %s" % err)
+        taggers = (xlator, seri)
+    return taggers
+
+
 def create_tagged(rec=None, args=None):
+    (xlator, seri) = get_taggers(args)
     try:
-        xlator = translator.Translator(doibib=doi_bibcode_dict, idpage=args.id_page, doipage=args.doi_page)
-    except Exception as err:
-        raise Exception("translator instantiation failed: %s" % err)
-    try:
-        seri = classic_serializer.ClassicSerializer(tag_refs=args.tagged_refs)
-    except Exception as err:
-        raise Exception("serializer instantiation failed: %s" % err)
-    try:
-        xlator.translate(data=rec, bibstem=args.bibstem, volume=args.volume, parsedfile=args.parsedfile)
-        if args.counter_page and xlator.output.get("bibcode", None):
-            use_counter_page(xlator.output, args.bibstem)
-        output = seri.output(xlator.output)
-        return output
+        with stage("translate"):
+            xlator.reset()
+            xlator.translate(data=rec, bibstem=args.bibstem, volume=args.volume, parsedfile=args.parsedfile)
+            if args.counter_page and xlator.output.get("bibcode", None):
+                use_counter_page(xlator.output, args.bibstem)
+        with stage("serialize"):
+            return seri.serialize(xlator.output)
     except Exception as err:
         raise Exception("TRANSLATE failed: %s" % err)
 
 
 def write_xml(inputRecord):
+    doi = inputRecord.get("name", None)
     try:
         if inputRecord.get("type", None) == "cr":
-            doi = inputRecord.get("name", None)
             raw_data = inputRecord.get("data", "")
             output_dir = conf.get("XML_OUTPUT_BASEDIR", "./doi/")
-            doi_to_path = doi.split("/")
-            path = []
-            if "http" in doi_to_path[0].lower():
-                doi_to_path = doi_to_path[3:]
-            for d in doi_to_path:
-                path.append(re.sub(r"[^\w_. -]+", "_", d))
-            filepath = "/".join(path)+'.xml'
-            output_path = output_dir + filepath
+            output_path = output_dir + doiharvest.doi_to_path(doi)
             dirname = os.path.dirname(output_path)
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
-            with open(output_path, "w") as fx:
-                fx.write("%s\n" % raw_data)
+            with stage("write_xml"):
+                with open(output_path, "w") as fx:
+                    fx.write("%s\n" % raw_data)
         else:
             raise Exception("This is not a crossref file.")
     except Exception as err:
+        count("failures", site="write_xml")
         logger.warning("Export of doi (%s) to xml failed: %s" % (doi, err))
 
 
+# one ReferenceStager per process, see get_ref_stager
+ref_stager = None
+
+def get_ref_stager(args):
+    global ref_stager
+    if ref_stager is None:
+        ref_stager = refstage.ReferenceStager(args.ref_dir, args.ref_staging)
+    return ref_stager
+
+
+def ref_staging_dir(args):
+    # the same output file always stages in the same place, so a later run
+    # can commit what an interrupted one left behind
+    key = hashlib.md5(os.path.abspath(args.output_file).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(conf.get("REF_STAGING_DIR", tempfile.gettempdir()), "adsmanparse-refs-%s" % key)
+
+
+def commit_refs(stager):
+    try:
+        nrefs = stager.commit()
+        if nrefs:
+            logger.debug("Committed %s reference files to %s" % (nrefs, stager.ref_dir))
+    except Exception as err:
+        logger.warning(err)
+
+
 def create_refs(rec=None, args=None, bibcode=None):
     try:
-        rw = ReferenceWriter(reference_directory=args.ref_dir,
-                             reference_source=args.source,
-                             bibcode=bibcode,
-                             data=rec)
-        rw.write_references_to_file()
+        with stage("refs"):
+            get_ref_stager(args).write(rec, bibcode, args.source)
     except Exception as err:
-        logger.warning("Unable to write references: %s" % err)
+        count("failures", site="refs")
+        logger.warning("Unable to write references for %s: %s" % (bibcode, err))
 
 def write_record(record, args):
     if args.output_file:
@@ -304,61 +516,111 @@ def write_record(record, args):
         try:
             tagged = create_tagged(rec=record, args=args)
         except Exception as err:
+            count("failures", site="translate")
             logger.warning("Failed to create_tagged record: %s" % err)
-        if tagged:
-            with open(args.output_file, "a") as fout:
-                fout.write("%s\n" % tagged)
-            tagged_list = tagged.split("\n")
-            bibcode=None
-            for l in tagged_list:
-                try:
-                    (tag, value) = l.strip().split()
-                    if tag == "%R":
-                        bibcode=value
-                        break
-                except Exception as noop:
-                    pass
+        if tagged and tagged.text:
+            count("translated")
             if args.write_refs:
-                create_refs(rec=record, bibcode=bibcode, args=args)
+                in_background(create_refs, rec=record, bibcode=tagged.bibcode, args=args)
+            return tagged
         else:
             raise Exception("Tagged record not generated.")
     else:
         raise Exception("Output_file not defined, no place to write records to!")
 
 
+def checkpoint_file(args):
+    return args.output_file + ".ckpt"
+
+
+def checkpointing(args):
+    return args.resume or args.checkpoint_every > 0
+
+
+def streaming(args):
+    return args.output_file == writer.STDOUT
+
+
+def open_output(args):
+    resume = False
+    if args.resume:
+        # drop whatever was written after the last checkpoint
+        (offset, done) = checkpoint.Checkpoint(checkpoint_file(args)).load()
+        if offset is None:
+            logger.warning("No checkpoint found for %s, starting from the beginning." % args.output_file)
+        else:
+            resume = True
+            ntrunc = checkpoint.truncate_output(args.output_file, offset)
+            if ntrunc:
+                logger.info("Removed %s bytes written to %s after the last checkpoint." % (ntrunc, args.output_file))
+    # a resumed run has already cut the output back to its last checkpoint,
+    # so the writer keeps what is left
+    flush_records = args.flush_records
+    if flush_records is None:
+        flush_records = 1 if streaming(args) else 0
+    return writer.TaggedWriter(args.output_file,
+                               buffer_size=args.buffer_size,
+                               flush_interval=args.flush_interval,
+                               fsync=args.fsync,
+                               resume=resume,
+                               flush_records=flush_records)
+
+
+def write_tagged(tagged, output):
+    with stage("write"):
+        output.write("%s\n" % tagged.text)
+    count("written")
+
+
 def parse_record(rec):
     pdata = rec.get('data', None)
     ptype = rec.get('type', None)
     filename = rec.get('name', "")
-    parser = PARSER_TYPES.get(ptype, None)
-    write_file = utils.has_body(pdata)
+    try:
+        parser = get_parser(ptype)
+    except Exception as err:
+        count("failures", site="parser")
+        logger.error("Failed to load parser for file_type '%s': %s" % (ptype, err))
+        parser = None
+    with stage("has_body"):
+        write_file = utils.has_body(pdata)
     parsedrecord = None
+    suppressed = None
     if not parser:
         logger.error("No parser available for file_type '%s'." % ptype)
     else:
         try:
-            parser.__init__()
-            if ptype == 'nlm':
-                parsedrecord = parser.parse(pdata, bsparser='lxml-xml')
-            else:
-                parsedrecord = parser.parse(pdata)
+            with stage("parse"):
+                parser.__init__()
+                if ptype == 'nlm':
+                    parsedrecord = parser.parse(pdata, bsparser='lxml-xml')
+                else:
+                    parsedrecord = parser.parse(pdata)
             if parsedrecord:
-                if utils.suppress_title(parsedrecord, conf.get("DEPRECATED_TITLES", [])):
+                suppressed = utils.suppress_title(parsedrecord, conf.get("DEPRECATED_TITLES", []))
+                if suppressed:
                     parsedrecord = None
-                    raise Exception("Warning: article matches a suppressed title.")
+                    # so the manifest knows it is done with this input
+                    rec["suppressed"] = suppressed
+                    count("suppressed")
+                    raise Exception("Warning: article matches a suppressed title (%s)." % suppressed)
                 if filename:
                     if not parsedrecord.get("recordData", {}).get("loadLocation", None):
                         parsedrecord["recordData"]["loadLocation"] = filename
                     if not write_file:
                         parsedrecord["recordData"]["loadLocation"] = None
+                count("parsed")
             else:
                 raise Exception("Null body returned by parser!")
         except Exception as err:
+            if not suppressed:
+                count("failures", site="parse")
             logger.warning("Error parsing record (%s): %s" % (filename,err))
     return parsedrecord
 
 
 def process_record(rec, args):
+    tagged = None
     try:
         parsedRecord = parse_record(rec)
         if not parsedRecord:
@@ -369,77 +631,506 @@ def process_record(rec, args):
             elif args.doi_page:
                parsedRecord = move_doiid(parsedRecord)
             try:
-                write_record(parsedRecord, args)
+                tagged = write_record(parsedRecord, args)
             except Exception as err:
                 logger.error("Classic tagger did not generate a tagged record for %s" % err)
             else:
                 #logger.debug("Successfully processed %s with %s" % (rec.get("name", None), str(args)))
                 pass
     except Exception as err:
+        count("failures", site="process")
         logger.error("Error parsing and processing record %s: %s" % (rec.get("name", ""), err))
+    return tagged
+
+
+def read_input_file(f, args):
+    with stage("read"):
+        with open(f, 'rb') as fin:
+            stat = os.fstat(fin.fileno())
+            raw = fin.read()
+        rec = {'data': io.TextIOWrapper(io.BytesIO(raw)).read(),
+               'name': f,
+               'type': args.file_type}
+    if args.incremental or args.manifest:
+        # the manifest records what was read here, rather than reading the
+        # file again
+        rec['sha1'] = hashlib.sha1(raw).hexdigest()
+        rec['stat'] = stat
+    return rec
+
+
+def _source(item):
+    # what the parent needs to know about an input once it is processed;
+    # key identifies the input in checkpoints
+    return {"name": item.get("name", None),
+            "key": item.get("key", None) or item.get("name", None),
+            "archive": item.get("archive", None),
+            "suppressed": bool(item.get("suppressed", None)),
+            "sha1": item.get("sha1", None),
+            "stat": item.get("stat", None)}
 
 
-def process_filepath(args):
+def _process_item(item, args):
+    # items are either input records, or paths to files that have not been
+    # read yet (so workers do the reading, not the writer); returns the
+    # _source of the item with the tagged record
+    if isinstance(item, str):
+        try:
+            item = read_input_file(item, args)
+        except Exception as err:
+            count("failures", site="read")
+            logger.warning("Failed to read input file %s: %s" % (item, err))
+            return ({"name": item, "key": item}, None)
+    try:
+        with stage("record"):
+            tagged = process_record(item, args)
+        return (_source(item), tagged)
+    except Exception as err:
+        count("failures", site="process")
+        logger.warning("Process record failed: %s" % err)
+        return (_source(item), None)
+
+
+# each worker process keeps its own copy of args (and of PARSER_TYPES)
+worker_args = None
+
+def _init_worker(args):
+    global worker_args, run_metrics, background
+    worker_args = args
+    # background I/O belongs to the parent; workers write their (locally
+    # staged) references themselves
+    background = None
+    if not conf:
+        setup()
+    if args.metrics:
+        # only counts, main() does the exporting
+        run_metrics = metrics.RunMetrics()
+
+
+def _process_worker(item):
+    (source, tagged) = _process_item(item, worker_args)
+    if tagged:
+        # the parent only writes text and records bibcode, so the fields
+        # (a second copy of the record) are not pickled back to it
+        tagged = tagged._replace(fields=None)
+    # whatever this worker observed goes back with the result
+    return (source, tagged, run_metrics.drain() if run_metrics else None)
+
+
+def _log_first_record():
+    logger.info("First record processed %.3f seconds after start." % (time.time() - start_time))
+
+
+def start_checkpointer(args, output, before_checkpoint=None, on_checkpoint=None):
+    if not checkpointing(args):
+        return (None, set())
+    checkpointer = checkpoint.Checkpointer(checkpoint.Checkpoint(checkpoint_file(args)),
+                                           output,
+                                           interval=args.checkpoint_every or conf.get("CHECKPOINT_EVERY", 500),
+                                           before_checkpoint=before_checkpoint,
+                                           on_checkpoint=on_checkpoint)
+    done = checkpointer.start(resume=args.resume)
+    if done:
+        logger.info("Resuming from checkpoint, %s inputs already done." % len(done))
+    return (checkpointer, done)
+
+
+def _item_key(item):
+    # input files are keyed on their path, records on the "key" they were
+    # given when they were read (e.g. archive!member, or file:line)
+    if isinstance(item, str):
+        return item
+    return item.get("key", None) or item.get("name", None)
+
+
+def _skip_done(items, done):
+    for item in items:
+        if _item_key(item) not in done:
+            yield item
+
+
+def resume_done(args):
+    # the inputs done according to the checkpoint a run would resume from
+    if not (checkpointing(args) and args.resume):
+        return set()
+    return checkpoint.Checkpoint(checkpoint_file(args)).load()[1]
+
+
+def open_ref_stager(args):
+    # set before any worker starts, so that they all stage in the same place
+    args.ref_staging = ref_staging_dir(args)
+    stager = get_ref_stager(args)
+    nleft = stager.open()
+    if nleft:
+        logger.info("Committed %s reference files staged by an earlier run." % nleft)
+    return stager
+
+
+def _background_error(err):
+    count("failures", site="background")
+    logger.warning("Background write failed: %s" % err)
+
+
+def open_background(args):
+    global background
+    nthreads = conf.get("IO_THREADS", 2)
+    if (args.write_refs or args.write_xref) and nthreads:
+        background = bgio.BackgroundIO(threads=nthreads,
+                                       max_pending=conf.get("IO_MAX_PENDING", 64),
+                                       on_error=_background_error).open()
+    return background
+
+
+def close_background():
+    global background
+    if background is not None:
+        background.close()
+        background = None
+
+
+def process_items(items, args, output, on_result=None):
+    # on_result, if given, is called with (source, tagged) for every item
+    stager = None
+    before_checkpoint = []
+    on_checkpoint = []
+    if args.write_refs:
+        stager = open_ref_stager(args)
+        on_checkpoint.append(lambda: in_background(commit_refs, stager))
+    if open_background(args):
+        # everything written for the records in a checkpoint is staged
+        # before the checkpoint is saved
+        before_checkpoint.append(background.drain)
+    try:
+        nproc = _process_items(items, args, output, on_result=on_result,
+                               before_checkpoint=before_checkpoint, on_checkpoint=on_checkpoint)
+    finally:
+        close_background()
+    if stager:
+        try:
+            stager.close()
+            logger.info("Committed %s reference files to %s" % (stager.ncommitted, args.ref_dir))
+        except Exception as err:
+            logger.error("%s; they will be committed by the next run writing %s" % (err, args.output_file))
+    return nproc
+
+
+def _bounded(items, slots, stop):
+    # the pool reads its input as fast as it can, so this holds it back to
+    # a fixed number of items that have been handed out but not returned
+    for item in items:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def _process_items(items, args, output, on_result=None, before_checkpoint=None, on_checkpoint=None):
+    (checkpointer, done) = start_checkpointer(args, output, before_checkpoint=before_checkpoint,
+                                              on_checkpoint=on_checkpoint)
+    if done:
+        items = _skip_done(items, done)
+    nproc = 0
+
+    def handle_result(source, tagged):
+        if nproc == 1:
+            _log_first_record()
+        if tagged:
+            write_tagged(tagged, output)
+        if on_result:
+            on_result(source, tagged)
+        if checkpointer:
+            checkpointer.add(source["key"])
+        if run_metrics:
+            try:
+                run_metrics.maybe_write()
+            except Exception as err:
+                logger.warning(err)
+
+    if args.workers and args.workers > 1:
+        pool = multiprocessing.Pool(processes=args.workers,
+                                    initializer=_init_worker,
+                                    initargs=(args,))
+        chunksize = conf.get("WORKER_CHUNKSIZE", 4)
+        slots = threading.Semaphore(max(conf.get("WORKER_MAX_INFLIGHT", args.workers * chunksize * 4), chunksize))
+        stop = threading.Event()
+        try:
+            if args.ordered:
+                results = pool.imap(_process_worker, _bounded(items, slots, stop), chunksize)
+            else:
+                results = pool.imap_unordered(_process_worker, _bounded(items, slots, stop), chunksize)
+            # the parent process is the only writer to args.output_file
+            for (source, tagged, observed) in results:
+                slots.release()
+                nproc += 1
+                if observed:
+                    run_metrics.merge(observed)
+                handle_result(source, tagged)
+            pool.close()
+        except BaseException:
+            # unblock the pool's task feeder so terminate() can join it
+            stop.set()
+            slots.release()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for item in items:
+            nproc += 1
+            handle_result(*_process_item(item, args))
+    if checkpointer:
+        checkpointer.finish()
+    return nproc
+
+
+def _count_old(path, stat):
+    count("files_found")
+    count("files_age_filtered")
+
+
+def _read_archive(archive, args, progress=None, filemanifest=None, stat=None):
+    # progress, if given, is a manifest.ArchiveProgress told about every
+    # member handed out and, at the end, about those that could not be read;
+    # with --incremental, members already done (according to filemanifest)
+    # are skipped unless the archive has changed since
+    nfailed = [0]
+
+    def bad_member(member, err):
+        nfailed[0] += 1
+        count("failures", site="read")
+        logger.warning("Failed to read %s from archive %s: %s" % (member, archive, err))
+
+    digest = None
+    if filemanifest:
+        try:
+            digest = filemanifest.digest(archive)
+        except Exception as err:
+            logger.warning("Manifest check failed for %s, processing all of it: %s" % (archive, err))
+    nmembers = 0
+    nskip = 0
+    try:
+        for (member, data) in utils.iter_archive(archive, pattern=args.members, on_error=bad_member):
+            key = "%s!%s" % (archive, member)
+            if args.incremental and digest:
+                entry = filemanifest.get(key)
+                if entry and entry["status"] in manifest.DONE_STATUSES and entry["sha1"] == digest:
+                    nskip += 1
+                    count("members_unchanged")
+                    continue
+            nmembers += 1
+            count("members_read")
+            if progress:
+                progress.add(archive)
+            yield {'data': data,
+                   'name': member,
+                   'key': key,
+                   'archive': archive,
+                   'sha1': digest,
+                   'stat': stat,
+                   'type': args.file_type}
+    except Exception as err:
+        nfailed[0] += 1
+        count("failures", site="archive")
+        logger.warning("Failed to read archive %s: %s" % (archive, err))
+    logger.debug("Read %s files from archive %s, skipped %s done before" % (nmembers, archive, nskip))
+    if progress:
+        try:
+            progress.finish(archive, failures=nfailed[0], digest=digest, stat=stat)
+        except Exception as err:
+            logger.warning("Failed to update manifest: %s" % err)
+
+
+def _find_infiles(args, filemanifest=None, found=None, progress=None):
+    # found, if given, counts the files found and those skipped as unchanged
+    if found is None:
+        found = {}
+    found.update(files=0, unchanged=0)
+    for (f, stat) in utils.find_files(args.proc_path, since=args.proc_since, on_old=_count_old):
+        count("files_found")
+        found["files"] += 1
+        if args.incremental:
+            try:
+                if not filemanifest.is_changed(f, stat):
+                    found["unchanged"] += 1
+                    count("files_unchanged")
+                    continue
+            except Exception as err:
+                logger.warning("Manifest check failed for %s, processing it: %s" % (f, err))
+        if utils.is_archive(f):
+            # the members are read here, and handed on as records; the
+            # archive is recorded once all of their results are back
+            for rec in _read_archive(f, args, progress, filemanifest, stat):
+                yield rec
+        else:
+            yield f
+    if args.incremental:
+        logger.info("Skipped %s files unchanged since they were last processed." % found["unchanged"])
+
+
+def flush_manifest(filemanifest, output):
+    # the records of the files about to be marked written must be on disk
+    # first, or a crash would leave them marked but missing
+    output.sync()
+    filemanifest.flush()
+
+
+def _record_result(filemanifest, progress, output):
+    def record(source, tagged):
+        bibcode = None
+        if tagged:
+            status = "written"
+            bibcode = tagged.bibcode
+        elif source.get("suppressed", False):
+            # a final outcome: the title stays suppressed next time too
+            status = "suppressed"
+        else:
+            status = "failed"
+        try:
+            if source.get("archive", None):
+                progress.done(source["archive"], status)
+            # archive members are keyed archive!member, and carry the hash
+            # and stat of their archive
+            filemanifest.record(source["key"], status, bibcode,
+                                digest=source.get("sha1", None), stat=source.get("stat", None))
+        except Exception as err:
+            logger.warning("Failed to update manifest: %s" % err)
+        if filemanifest.due():
+            try:
+                flush_manifest(filemanifest, output)
+            except Exception as err:
+                logger.warning("Failed to update manifest: %s" % err)
+    return record
+
+
+def open_manifest(args):
+    manifest_file = args.manifest or conf.get("MANIFEST_FILE", "./manifest.db")
+    return manifest.RunManifest(manifest_file)
+
+
+def process_filepath(args, output):
     if args.proc_path:
         logger.info("Finding files in path %s ..." % args.proc_path)
-        infiles = [x for x in iglob(args.proc_path, recursive=True)]
-        if not infiles:
-            logger.warning("No files found in path %s." % args.proc_path)
-        else:
-            logger.info("Found %s files." % len(infiles))
-            if args.proc_since:
-                logger.info("Checking file ages...")
-                dtime = timedelta(days=int(args.proc_since))
-                today = datetime.today()
-                infiles_since = [x for x in infiles if ((today - datetime.fromtimestamp(os.path.getmtime(x))) <= dtime)]
-                infiles = infiles_since
-            if not infiles:
+        if args.proc_since:
+            logger.info("Only processing files less than %s days old." % str(args.proc_since))
+        filemanifest = None
+        progress = None
+        on_result = None
+        found = {}
+        if args.incremental or args.manifest:
+            filemanifest = open_manifest(args).open()
+            progress = manifest.ArchiveProgress(filemanifest)
+            on_result = _record_result(filemanifest, progress, output)
+        try:
+            nfiles = process_items(_find_infiles(args, filemanifest, found, progress), args, output,
+                                   on_result=on_result)
+        finally:
+            if filemanifest:
+                try:
+                    flush_manifest(filemanifest, output)
+                except Exception as err:
+                    logger.warning("Failed to update manifest, it is left as it was: %s" % err)
+                filemanifest.close(flush=False)
+        if not nfiles:
+            if found.get("unchanged", 0):
+                logger.info("Nothing to process in path %s, the %s files found there are unchanged since they were last processed."
+                            % (args.proc_path, found["unchanged"]))
+            elif args.proc_since:
                 logger.error("No files more recent than %s days old!" % str(args.proc_since))
             else:
-                nfiles = len(infiles)
-                logger.info("There were %s files found to process" % str(nfiles))
-                for f in infiles:
-                    inputRecord = {}
-                    try:
-                        with open(f, 'r') as fin:
-                            inputRecord = {'data': fin.read(),
-                                           'name': f,
-                                           'type': args.file_type}
-                    except Exception as err:
-                        logger.warning("Failed to read input file %s: %s" % (f, err))
-                    else:
-                        try:
-                            process_record(inputRecord, args)
-                        except Exception as err:
-                            logger.warning("Process record failed: %s" % err)
+                logger.warning("No files found in path %s." % args.proc_path)
+        else:
+            logger.info("Processed %s files." % str(nfiles))
     else:
         logger.warning("Null processing path given, nothing processed.")
 
 
-def process_doilist(doilist, args):
+def _read_jsonl(args):
+    def bad_line(lineno, err):
+        count("failures", site="jsonl")
+        logger.warning("Skipping line %s of %s, not valid JSON: %s" % (lineno, args.jsonl, err))
+
+    for (lineno, rec) in utils.iter_jsonl(args.jsonl, on_error=bad_line, numbered=True):
+        if not isinstance(rec, dict) or not rec.get("data", None):
+            count("failures", site="jsonl")
+            logger.warning("Skipping a record with no data in %s" % args.jsonl)
+            continue
+        if not rec.get("type", None):
+            if not args.file_type:
+                count("failures", site="jsonl")
+                logger.warning("Skipping record %s: no type, and no --file_type given" % rec.get("name", None))
+                continue
+            rec["type"] = args.file_type
+        rec.setdefault("name", "")
+        # names are optional and need not be unique, so checkpoints use the
+        # line the record came from
+        rec["key"] = "%s:%s" % (args.jsonl, lineno)
+        yield rec
+
+
+def process_jsonl(args, output):
+    logger.info("Reading records from %s ..." % ("stdin" if args.jsonl == "-" else args.jsonl))
+    nrecs = process_items(_read_jsonl(args), args, output)
+    if nrecs:
+        logger.info("Processed %s records." % str(nrecs))
+    else:
+        logger.warning("No records found in %s." % args.jsonl)
+
+
+def get_doi_cache(args):
+    cache_dir = conf.get("DOI_CACHE_DIR", "./doi_cache/")
+    if args.no_cache or not cache_dir:
+        return None
+    return doiharvest.DoiCache(cache_dir,
+                               max_age=conf.get("DOI_CACHE_MAX_AGE", 30 * 86400),
+                               max_bytes=conf.get("DOI_CACHE_MAX_BYTES", 2 * 1024 ** 3),
+                               warm_dirs=[conf.get("XML_OUTPUT_BASEDIR", "./doi/")])
+
+
+def _harvest_dois(doilist, args):
+    ptype = args.file_type
+    if not ptype:
+        ptype = 'cr'
+    harvester = doiharvest.DoiHarvestPool(concurrency=args.harvest_workers,
+                                          rate_limit=conf.get("HARVEST_RATE_LIMIT", 10.),
+                                          max_retries=conf.get("HARVEST_MAX_RETRIES", 3),
+                                          backoff=conf.get("HARVEST_BACKOFF", 1.),
+                                          timeout=conf.get("HARVEST_TIMEOUT", 60.),
+                                          base_url=conf.get("HARVEST_BASE_URL", "https://doi.org"),
+                                          mailto=conf.get("HARVEST_MAILTO", None),
+                                          cache=get_doi_cache(args))
+    for (d, doi_record, error) in harvester.harvest(doilist):
+        if error:
+            count("failures", site="harvest")
+            logger.warning("Failed to fetch doi %s: %s" % (d, error))
+            continue
+        count("dois_fetched")
+        inputRecord = {'data': doi_record,
+                       'name': d,
+                       'type': ptype}
+        if args.write_xref:
+            in_background(write_xml, inputRecord)
+        yield inputRecord
+    if harvester.cache:
+        logger.info("DOI cache statistics: %s" % harvester.cache.stats)
+
+
+def process_doilist(doilist, args, output):
+    done = resume_done(args)
+    if doilist and done:
+        # so the DOIs already done are not fetched again
+        ndois = len(doilist)
+        doilist = [d for d in doilist if d not in done]
+        logger.info("Skipping %s DOIs done before the checkpoint." % (ndois - len(doilist)))
+        if not doilist:
+            logger.info("All DOIs were done before the checkpoint, nothing processed.")
+            return
     if doilist:
-        ptype = args.file_type
-        if not ptype:
-            ptype = 'cr'
-        for d in doilist:
-            try:
-                getdoi = doiharvest.DoiHarvester(doi=d)
-                doi_record = getdoi.get_record()
-                inputRecord = {'data': doi_record,
-                               'name': d,
-                               'type': ptype}
-                if args.write_xref:
-                    write_xml(inputRecord)
-            except Exception as err:
-                logger.warning("Failed to fetch doi %s: %s" % (d, err))
-            else:
-                process_record(inputRecord, args)
+        process_items(_harvest_dois(doilist, args), args, output)
     else:
         logger.warning("No DOIs provided, nothing processed.")
 
 
-def main():
-    args = get_args()
+def run(args):
     rawDataList = []
     ingestDocList = []
 
@@ -449,10 +1140,18 @@ def main():
     if args.proc_path and not args.file_type:
         fileTypeList = PARSER_TYPES.keys()
         logger.error("You need to provide a filetype from this list: %s" % str(fileTypeList))
+    elif streaming(args) and checkpointing(args):
+        logger.error("Checkpoints need an output file, they cannot be used when writing to stdout.")
     else:
         # This route processes data from user-input files
         if args.proc_path:
-            process_filepath(args)
+            with open_output(args) as output:
+                process_filepath(args, output)
+
+        # This route streams records from a JSON lines file or stdin
+        elif args.jsonl:
+            with open_output(args) as output:
+                process_jsonl(args, output)
 
         # This route fetches data from Crossref via the Habanero module
         elif (args.fetch_doi or args.fetch_doi_list):
@@ -464,7 +1163,49 @@ def main():
                 with open(args.fetch_doi_list, 'r') as fin:
                     for l in fin.readlines():
                         doiList.append(l.strip())
-            process_doilist(doiList, args)
+            with open_output(args) as output:
+                process_doilist(doiList, args, output)
+
+
+def main():
+    global profiler, run_metrics
+    args = get_args()
+    if streaming(args):
+        # stdout carries the tagged records, so anything else printed
+        # (including LOG_STDOUT logging) goes to stderr
+        sys.stdout = sys.stderr
+    setup()
+
+    args.metrics = args.metrics or conf.get("METRICS_PREFIX", None)
+    if args.metrics:
+        ftype = args.file_type
+        if not ftype and (args.fetch_doi or args.fetch_doi_list):
+            ftype = 'cr'
+        run_metrics = metrics.RunMetrics(args.metrics,
+                                         labels={"type": ftype or ""},
+                                         interval=args.metrics_interval)
+
+    if args.profile or args.profile_memory:
+        if args.workers and args.workers > 1:
+            logger.warning("Profiling only covers the parent process, not the --workers processes.")
+        profiler = profiling.RunProfiler(args.profile or "./run_profile",
+                                         cpu=bool(args.profile),
+                                         memory=args.profile_memory).start()
+    try:
+        run(args)
+    except writer.TaggedWriterException as err:
+        logger.error(err)
+        sys.exit(1)
+    finally:
+        if profiler:
+            summary = profiler.stop()
+            logger.info("Profile summary written to %s" % summary)
+        if run_metrics:
+            try:
+                outfiles = run_metrics.write()
+                logger.info("Run metrics written to %s" % ", ".join(outfiles))
+            except Exception as err:
+                logger.warning(err)
 
 
 if __name__ == '__main__':